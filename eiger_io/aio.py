@@ -0,0 +1,171 @@
+''' asyncio counterparts of the EIGER readers.
+
+    File access and decompression are blocking, so they run on an executor.
+    A semaphore bounds the number of reads in flight per reader, callers
+    beyond that wait (without holding a thread) until a read completes.
+
+    usage (for example)::
+
+        imgs = await AsyncEigerImages.open(master_path, images_per_file)
+        frame = await imgs.aget_frame(10)
+        async for frame in imgs.aiter_frames(0, 100):
+            ...
+        await imgs.aclose()
+'''
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .fs_handler import EigerHandler, EigerImages
+
+
+class _Scheduler(object):
+    ''' Run blocking calls on an executor with a bound on outstanding calls.
+
+        The executor is shut down on close if it was created here.
+    '''
+    def __init__(self, executor=None, max_concurrency=16):
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_concurrency)
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, func, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+
+class AsyncEigerImages(object):
+    ''' Async access to an ``EigerImages``.
+
+        Use ``AsyncEigerImages.open`` rather than creating this directly.
+
+        Parameters
+        ----------
+        images : EigerImages
+            the reader to wrap
+
+        scheduler : _Scheduler
+            runs the blocking calls
+
+        own_scheduler : bool, optional
+            close the scheduler along with the reader
+    '''
+    def __init__(self, images, scheduler, own_scheduler=False):
+        self.images = images
+        self._scheduler = scheduler
+        self._own_scheduler = own_scheduler
+
+    @classmethod
+    async def open(cls, master_filepath, images_per_file, md=None,
+                   executor=None, max_concurrency=16, **kwargs):
+        ''' Open a run without blocking the event loop.
+
+            Parameters
+            ----------
+            master_filepath, images_per_file, md
+                as for ``EigerImages``, extra keyword arguments are passed on
+
+            executor : concurrent.futures.Executor, optional
+                where the blocking calls run. By default a thread pool owned
+                by this reader.
+
+            max_concurrency : int, optional
+                the maximum number of reads in flight
+        '''
+        scheduler = _Scheduler(executor, max_concurrency)
+        images = await scheduler.run(
+            lambda: EigerImages(master_filepath, images_per_file, md=md,
+                                **kwargs))
+        return cls(images, scheduler, own_scheduler=True)
+
+    @property
+    def md(self):
+        return self.images.md
+
+    async def alen(self):
+        ''' The number of frames (may need to open the data files).'''
+        return await self._scheduler.run(len, self.images)
+
+    async def aget_frame(self, i):
+        ''' Read frame i.'''
+        return await self._scheduler.run(self.images.get_frame, i)
+
+    async def aiter_frames(self, start=0, stop=None, step=1, prefetch=4):
+        ''' Iterate over a range of frames, in order.
+
+            Up to ``prefetch`` frames are read ahead of the consumer.
+        '''
+        if stop is None:
+            stop = await self.alen()
+        pending = deque()
+        indices = iter(range(start, stop, step))
+        try:
+            for i in indices:
+                pending.append(asyncio.ensure_future(self.aget_frame(i)))
+                if len(pending) >= prefetch:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        await self._scheduler.run(self.images.close)
+        if self._own_scheduler:
+            self._scheduler.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class AsyncEigerHandler(object):
+    ''' Async version of ``EigerHandler``.
+
+        Takes the same resource kwargs as ``EigerHandler``. All readers it
+        returns share one executor and one bound on outstanding reads.
+    '''
+    specs = EigerHandler.specs
+
+    def __init__(self, fpath, images_per_file=None, frame_per_point=None,
+                 executor=None, max_concurrency=16):
+        self._handler = EigerHandler(fpath, images_per_file=images_per_file,
+                                     frame_per_point=frame_per_point)
+        self._scheduler = _Scheduler(executor, max_concurrency)
+
+    async def aload_metadata(self, seq_id):
+        ''' Read the metadata of one sequence.'''
+        master_path = self._handler._master_path(seq_id)
+        return await self._scheduler.run(self._handler._load_md,
+                                         master_path)
+
+    async def __call__(self, seq_id, frame_num=None):
+        ''' Same as ``EigerHandler.__call__``, but the whole run is wrapped
+            in an ``AsyncEigerImages``.
+        '''
+        md = await self.aload_metadata(seq_id)
+        master_path = self._handler._master_path(seq_id)
+        images = await self._scheduler.run(
+            lambda: EigerImages(master_path, self._handler._images_per_file,
+                                md=md))
+        ret = AsyncEigerImages(images, self._scheduler)
+        if frame_num is not None:
+            try:
+                return await ret.aget_frame(frame_num)
+            finally:
+                await self._scheduler.run(images.close)
+        return ret
+
+    def close(self):
+        self._scheduler.close()
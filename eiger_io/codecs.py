@@ -0,0 +1,184 @@
+''' Decoders for the compressed frame formats written by EIGER detectors.
+
+    The bitshuffle/LZ4 byte stream is the same whether it comes from the
+    HDF5 filter (id 32008) or from the stream interface: a 12 byte header
+    (big-endian uncompressed size and block size in bytes) followed by the
+    LZ4 compressed blocks. This lets us decode frames without HDF5.
+
+    bitshuffle and lz4 are optional, they are only needed when compressed
+    data is actually decoded.
+'''
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# HDF5 filter ids registered for the EIGER compression schemes
+H5Z_FILTER_LZ4 = 32004
+H5Z_FILTER_BSHUF = 32008
+
+# bitshuffle aims for blocks of this many bytes by default
+_BSHUF_TARGET_BLOCK_BYTES = 8192
+
+
+def _require(module, name):
+    if module is None:
+        raise ImportError("The {} package is required to decode this "
+                          "data.".format(name))
+
+
+def bslz4_decode(buf, shape, dtype):
+    ''' Decode a bitshuffle/LZ4 buffer (with its 12 byte header).
+
+        Parameters
+        ----------
+        buf : bytes-like
+            the compressed data
+
+        shape : tuple
+            the shape of the decoded array
+
+        dtype : numpy.dtype
+            the type of the decoded array
+
+        Returns
+        -------
+        arr : numpy.ndarray
+    '''
+    _require(bitshuffle, 'bitshuffle')
+    dtype = np.dtype(dtype)
+    nbytes, block_bytes = struct.unpack('>QI', bytes(buf[:12]))
+    if nbytes != int(np.prod(shape)) * dtype.itemsize:
+        raise ValueError("Compressed buffer holds {} bytes, expected shape "
+                         "{} of {}".format(nbytes, shape, dtype))
+    payload = np.frombuffer(buf, dtype=np.uint8, offset=12)
+    return bitshuffle.decompress_lz4(payload, tuple(shape), dtype,
+                                     block_bytes // dtype.itemsize)
+
+
+def bslz4_encode(arr):
+    ''' Encode an array as bitshuffle/LZ4 with the 12 byte header.'''
+    _require(bitshuffle, 'bitshuffle')
+    arr = np.ascontiguousarray(arr)
+    block_size = _BSHUF_TARGET_BLOCK_BYTES // arr.dtype.itemsize
+    header = struct.pack('>QI', arr.nbytes, block_size * arr.dtype.itemsize)
+    return header + bitshuffle.compress_lz4(arr, block_size).tobytes()
+
+
+def h5lz4_decode(buf, shape, dtype):
+    ''' Decode a chunk written by the HDF5 LZ4 filter (id 32004).
+
+        The chunk is a 12 byte header (big-endian uncompressed size and
+        block size) then, for every block, its big-endian compressed size
+        and data. Blocks that did not compress are stored as they are.
+    '''
+    _require(lz4, 'lz4')
+    buf = memoryview(buf)
+    nbytes, block_bytes = struct.unpack('>QI', bytes(buf[:12]))
+    out = bytearray(nbytes)
+    pos, filled = 12, 0
+    while filled < nbytes:
+        size, = struct.unpack('>I', bytes(buf[pos:pos + 4]))
+        pos += 4
+        n = min(block_bytes, nbytes - filled)
+        if size == n:
+            out[filled:filled + n] = buf[pos:pos + size]
+        else:
+            out[filled:filled + n] = lz4.block.decompress(
+                bytes(buf[pos:pos + size]), uncompressed_size=n)
+        pos += size
+        filled += n
+    return np.frombuffer(out, dtype=dtype).reshape(shape)
+
+
+def lz4_decode(buf, shape, dtype):
+    ''' Decode a single raw LZ4 block into an array.'''
+    _require(lz4, 'lz4')
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = lz4.block.decompress(bytes(buf), uncompressed_size=nbytes)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def lz4_encode(arr):
+    ''' Encode an array as a single raw LZ4 block.'''
+    _require(lz4, 'lz4')
+    return lz4.block.compress(np.ascontiguousarray(arr).tobytes(),
+                              store_size=False)
+
+
+def _decode_bshuf(buf, shape, dtype, values):
+    # cd_values are (major, minor, element size, block size, compression)
+    if len(values) < 5 or values[4] != 2:
+        raise ValueError("Only bitshuffle with LZ4 compression is supported")
+    return bslz4_decode(buf, shape, dtype)
+
+
+# filter id -> decode(buf, shape, dtype, cd_values), for the last filter of
+# a pipeline (the one producing the array)
+_CHUNK_DECODERS = {
+    1: lambda buf, shape, dtype, values: np.frombuffer(
+        zlib.decompress(buf), dtype=dtype).reshape(shape),
+    H5Z_FILTER_BSHUF: _decode_bshuf,
+    H5Z_FILTER_LZ4: lambda buf, shape, dtype, values: h5lz4_decode(
+        buf, shape, dtype),
+}
+
+
+def can_decode(filters):
+    ''' True if ``decode_chunk`` handles this filter pipeline.
+
+        Parameters
+        ----------
+        filters : list of (filter id, cd_values)
+            the filter pipeline of a dataset, in the order HDF5 applies
+            them when writing
+    '''
+    if len(filters) > 1:
+        return False
+    if not filters:
+        return True
+    code, values = filters[0]
+    if code == H5Z_FILTER_BSHUF:
+        return len(values) >= 5 and values[4] == 2 and bitshuffle is not None
+    if code == H5Z_FILTER_LZ4:
+        return lz4 is not None
+    return code in _CHUNK_DECODERS
+
+
+def decode_chunk(buf, filters, shape, dtype):
+    ''' Decode one chunk read from an HDF5 file without going through HDF5.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            the chunk as stored in the file
+
+        filters : list of (filter id, cd_values)
+            the filter pipeline of the dataset, see ``can_decode``
+
+        shape : tuple
+            the chunk shape
+
+        dtype : numpy.dtype
+            the dataset type
+
+        Returns
+        -------
+        arr : numpy.ndarray
+            possibly read-only
+    '''
+    if not filters:
+        return np.frombuffer(buf, dtype=dtype).reshape(shape)
+    code, values = filters[0]
+    return _CHUNK_DECODERS[code](buf, shape, dtype, values)
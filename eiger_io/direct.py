@@ -0,0 +1,332 @@
+''' Read EIGER data files without libhdf5.
+
+    Given the chunk table of every data file (from the sidecar index, see
+    ``eiger_io.index``), compressed chunks are fetched with ``os.pread`` and
+    decoded with ``eiger_io.codecs``. Neither step takes the h5py lock, so
+    readers scale across threads. Chunks that are close together in a file
+    are fetched with one large read.
+
+    Anything the decoders do not handle (unknown filters, skipped filters)
+    is read through h5py instead.
+
+    A ``ChunkCache`` keeps the compressed chunks read, so that later reads
+    of the same frames only decode. Compressed chunks are many times
+    smaller than frames, so a whole run often fits.
+'''
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .codecs import can_decode, decode_chunk
+
+
+def coalesce(rows, max_gap, max_read):
+    ''' Group chunks into reads.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            chunk table rows, the last three columns being byte offset,
+            size and filter mask
+
+        max_gap : int
+            the largest gap (in bytes) between chunks of one read
+
+        max_read : int
+            the largest read (in bytes), unless a single chunk is larger
+
+        Returns
+        -------
+        reads : list of (offset, length, rows)
+            rows sorted by byte offset
+    '''
+    rows = rows[np.argsort(rows[:, -3], kind='stable')]
+    reads = []
+    first = 0
+    for j in range(1, len(rows) + 1):
+        start = rows[first, -3]
+        end = rows[j - 1, -3] + rows[j - 1, -2]
+        if (j < len(rows) and rows[j, -3] - end <= max_gap and
+                rows[j, -3] + rows[j, -2] - start <= max_read):
+            continue
+        reads.append((int(start), int(end - start), rows[first:j]))
+        first = j
+    return reads
+
+
+class ChunkCache(object):
+    ''' Compressed chunks in memory, the least recently used being dropped
+        beyond a size. Can be shared between readers and threads.
+
+        Parameters
+        ----------
+        nbytes : int
+            the most bytes of chunks to keep
+
+        Attributes
+        ----------
+        hits, misses : int
+            the number of chunks found and not found
+    '''
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self._chunks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # the chunks are not carried over
+        return {'nbytes': self.nbytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # the lock may have been held by a thread that was not forked
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def get(self, key):
+        ''' The chunk stored under key, or None.'''
+        self._check_fork()
+        with self._lock:
+            buf = self._chunks.get(key)
+            if buf is None:
+                self.misses += 1
+                return None
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return buf
+
+    def put(self, key, buf):
+        ''' Keep buf (bytes) under key, unless larger than the cache.'''
+        self._check_fork()
+        if len(buf) > self.nbytes:
+            return
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._chunks[key] = buf
+            self._size += len(buf)
+            while self._size > self.nbytes:
+                _, old = self._chunks.popitem(last=False)
+                self._size -= len(old)
+
+    @property
+    def size(self):
+        ''' The bytes of chunks held.'''
+        return self._size
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._size = 0
+
+
+class ChunkReader(object):
+    ''' Read frames of a run from the raw chunks of its data files.
+
+        Parameters
+        ----------
+        index : eiger_io.index.RunIndex
+            the layout of the run
+
+        n_workers : int, optional
+            the number of threads decoding chunks of one read
+
+        chunk_cache : ChunkCache, optional
+            where to keep the compressed chunks read
+
+        gain : numpy.ndarray, optional
+            of shape frame_shape, multiplies every chunk as it is placed in
+            the output (which should then be floating point), e.g. the
+            flatfield with masked pixels zeroed
+
+        Attributes
+        ----------
+        max_gap : int
+            gaps up to this many bytes between chunks are read rather than
+            skipped, to make fewer, larger reads
+
+        max_read : int
+            the largest single read, in bytes
+    '''
+    max_gap = 1 << 16
+    max_read = 1 << 26
+
+    def __init__(self, index, n_workers=1, chunk_cache=None, gain=None):
+        self.index = index
+        self.n_workers = n_workers
+        self.chunk_cache = chunk_cache
+        self.gain = gain
+        self._pid = os.getpid()
+        self._starts = np.cumsum([0] + index.frame_counts)
+        self._fds = {}
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if n_workers > 1:
+            self._executor = ThreadPoolExecutor(n_workers)
+
+    def __getstate__(self):
+        return {'index': self.index, 'n_workers': self.n_workers,
+                'chunk_cache': self.chunk_cache, 'gain': self.gain}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    @property
+    def frame_shape(self):
+        return self.index.frame_shape
+
+    @property
+    def dtype(self):
+        return self.index.dtype
+
+    def _fd(self, i):
+        with self._lock:
+            if i not in self._fds:
+                self._fds[i] = os.open(self.index.data_path(i), os.O_RDONLY)
+            return self._fds[i]
+
+    def _dataset(self, i):
+        with self._lock:
+            if i not in self._datasets:
+                import h5py
+                f = h5py.File(self.index.data_path(i), 'r')
+                self._datasets[i] = f[self.index.files[i]['dataset']]
+            return self._datasets[i]
+
+    def get_frame(self, i):
+        return self.read_range(i, i + 1)[0]
+
+    def read_range(self, start, stop, out=None):
+        ''' Read frames [start, stop).
+
+            Parameters
+            ----------
+            out : numpy.ndarray, optional
+                where to write the frames, of shape
+                (stop - start,) + frame_shape
+
+            Returns
+            -------
+            out : numpy.ndarray
+        '''
+        if not 0 <= start <= stop <= len(self):
+            raise IndexError("Frames {}:{} out of range for a run of {} "
+                             "frames".format(start, stop, len(self)))
+        if self._pid != os.getpid():
+            # forked, do not share file handles or threads with the parent
+            self.__init__(self.index, self.n_workers, self.chunk_cache,
+                          self.gain)
+        if out is None:
+            out = np.empty((stop - start,) + self.frame_shape,
+                           dtype=self.dtype)
+        i = start
+        while i < stop:
+            f = int(np.searchsorted(self._starts, i, side='right')) - 1
+            j = min(stop, int(self._starts[f + 1]))
+            a = i - int(self._starts[f])
+            self._read_file(f, a, a + j - i, out[i - start:j - start])
+            i = j
+        return out
+
+    def _read_file(self, f, a, b, out):
+        ''' Read frames [a, b) of data file f into out.'''
+        filters = self.index.files[f]['filters']
+        chunks = self.index.chunk_shape
+        table = self.index.chunk_table(f)
+        rows = table[(table[:, 0] < b) & (table[:, 0] + chunks[0] > a)]
+        if not can_decode(filters) or rows[:, -1].any():
+            self._dataset(f).read_direct(out, np.s_[a:b])
+            if self.gain is not None:
+                out *= self.gain
+            return
+        n_spatial = int(np.prod([-(-n // c) for n, c in
+                                 zip(self.frame_shape, chunks[1:])]))
+        if len(rows) < n_spatial * (-(-b // chunks[0]) - a // chunks[0]):
+            # chunks that were never written hold the fill value
+            fill = self.index.files[f].get('fillvalue')
+            out[...] = self._dataset(f).fillvalue if fill is None else fill
+            if self.gain is not None:
+                out *= self.gain
+        # (row, compressed chunk) to decode
+        jobs = []
+        cache = self.chunk_cache
+        if cache is not None:
+            path = self.index.data_path(f)
+            missing = []
+            for row in rows:
+                buf = cache.get((path, int(row[-3])))
+                if buf is None:
+                    missing.append(row)
+                else:
+                    jobs.append((row, buf))
+            rows = np.array(missing, dtype=rows.dtype).reshape(-1,
+                                                               rows.shape[1])
+        if len(rows):
+            fd = self._fd(f)
+        for offset, length, group in coalesce(rows, self.max_gap,
+                                              self.max_read):
+            buf = memoryview(os.pread(fd, length, offset))
+            for row in group:
+                pos = int(row[-3]) - offset
+                chunk = buf[pos:pos + int(row[-2])]
+                if cache is not None:
+                    # a copy, not to keep the whole read alive
+                    chunk = bytes(chunk)
+                    cache.put((path, int(row[-3])), chunk)
+                jobs.append((row, chunk))
+
+        def place(job):
+            row, chunk = job
+            arr = decode_chunk(chunk, filters, chunks, self.dtype)
+            self._place(arr, row, a, b, out)
+        if self._executor is not None and len(jobs) > 1:
+            list(self._executor.map(place, jobs))
+        else:
+            for job in jobs:
+                place(job)
+
+    def _place(self, arr, row, a, b, out):
+        t0 = int(row[0])
+        t_lo, t_hi = max(a, t0), min(b, t0 + arr.shape[0])
+        dst = [slice(t_lo - a, t_hi - a)]
+        src = [slice(t_lo - t0, t_hi - t0)]
+        for k, n in enumerate(self.frame_shape):
+            lo = int(row[k + 1])
+            hi = min(n, lo + arr.shape[k + 1])
+            dst.append(slice(lo, hi))
+            src.append(slice(0, hi - lo))
+        if self.gain is None:
+            out[tuple(dst)] = arr[tuple(src)]
+        else:
+            # corrected while the decoded chunk is still in cache
+            np.multiply(arr[tuple(src)], self.gain[tuple(dst[1:])],
+                        out=out[tuple(dst)], casting='unsafe')
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+            for dataset in self._datasets.values():
+                dataset.file.close()
+            self._datasets.clear()
+        if self._executor is not None:
+            self._executor.shutdown()
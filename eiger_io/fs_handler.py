@@ -1,25 +1,90 @@
-import h5py
+import numpy as np
 import os
 import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import glob
 
 from pims import FramesSequence, Frame
 
-try:
-    # databroker v0.9.0
-    from databroker.assets.handlers import HandlerBase
-except ImportError:
-    # databroker < v0.9.0
-    from filestore.retrieve import HandlerBase
+from .direct import ChunkCache, ChunkReader
+from .index import RunIndex
+from .metadata import _expected_length, load_metadata
+
+# h5py (and dask, in fs_handler_dask) are imported where they are first
+# used, so that loading a handler registry does not pay for them
+
+
+class HandlerBase(object):
+    ''' The handler interface of databroker (and filestore).
+
+        Defined here rather than imported, as importing databroker takes
+        longer than anything the handlers do, and is not needed to read
+        files outside of databroker.
+    '''
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_file_list(self, datum_kwarg_gen):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# the flatfield correction and pixel mask of the detector
+FLATFIELD_PATH = 'entry/instrument/detector/detectorSpecific/flatfield'
+PIXEL_MASK_PATH = 'entry/instrument/detector/detectorSpecific/pixel_mask'
+
+
+def _counts_from_last(n_files, images_per_file, last):
+    ''' The number of frames in each data file, from the number in the last
+        one: the detector fills every data file but the last, so the others
+        need not be opened.
+
+        Returns None if last does not fit in a data file, i.e.
+        images_per_file is not that of the run.
+    '''
+    if n_files == 0:
+        return []
+    if not 0 <= last <= images_per_file:
+        return None
+    return [images_per_file] * (n_files - 1) + [last]
 
 
 class EigerImages(FramesSequence):
+    ''' The frames of one EIGER run, from its master file.
+
+        An instance can be shared between threads: each thread reads with
+        its own file handles, and threads asking for the same frame at the
+        same time share one read.
+    '''
     # the regexp patterns for expected files
     # here it is just file containing "master" but could potentially be
     # expanded upon
     pattern = re.compile('(.*)master.*')
+    # data files are opened on first use, at most this many stay open
+    max_open_files = 64
+    # the largest chunk cache rdcc_nbytes='auto' gives one data file
+    max_chunk_cache = 1 << 28
 
-    def __init__(self, master_filepath, images_per_file, md=None):
+    def __init__(self, master_filepath, images_per_file, md=None,
+                 swmr=False, index=None, direct=False, raw=False,
+                 memory_budget=None, on_exceed='raise', rdcc_nbytes=None,
+                 rdcc_nslots=None, rdcc_w0=None, staging=None,
+                 chunk_cache=None, flatfield=False):
         # check that 'master' is in file
         m = self.pattern.match(os.path.basename(master_filepath))
 
@@ -31,18 +96,308 @@ class EigerImages(FramesSequence):
         self._md = md
         self.master_filepath = master_filepath
         self.images_per_file = images_per_file
-        self._handle = h5py.File(master_filepath, 'r')
+        self.swmr = swmr
+        # return plain arrays rather than pims Frames
+        self.raw = raw
+        # the most bytes get_frames may allocate, see _check_budget
+        if on_exceed not in ('raise', 'stream'):
+            raise ValueError("on_exceed must be 'raise' or 'stream'")
+        self.memory_budget = memory_budget
+        self.on_exceed = on_exceed
+        # chunk cache of the data files, as for h5py.File (None keeps the
+        # HDF5 default). 'auto' sizes it from the chunking and from how the
+        # frames are read, see _chunk_cache. Readers of one process share
+        # a data file that is open in both, with the cache of the first.
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.rdcc_w0 = rdcc_w0
+        # an eiger_io.staging.StagingCache, data files are read from their
+        # local copy once it is complete
+        self.staging = staging
+        # frame count of each data file, filled on first use by refresh()
+        self._counts = None
+        # compressed chunks kept in memory (a ChunkCache, or its size in
+        # bytes), for direct reads which it turns on
+        if isinstance(chunk_cache, int):
+            chunk_cache = ChunkCache(chunk_cache)
+        self.chunk_cache = chunk_cache
+        direct = direct or chunk_cache is not None
+        if swmr:
+            # a sidecar index describes a finished run, it is no use when
+            # following a run being written
+            index = None
+        elif index is True or direct:
+            try:
+                index = RunIndex.open(master_filepath)
+            except (KeyError, OSError, ValueError):
+                # a layout the index does not describe (e.g. data in the
+                # master file) is read through HDF5
+                index = None
+        self.index = index or None
+        if self.index is not None:
+            self._counts = self.index.frame_counts
+        self.direct = direct and self.index is not None
+        # return float32 frames multiplied by the flatfield, with the
+        # masked pixels zeroed, see _load_gain
+        self.flatfield = flatfield
+        self._gain = None
+        self._init_state()
+        self._open()
+        if flatfield:
+            self._gain = self._load_gain()
+            if self._direct is not None:
+                self._direct.gain = self._gain
+        if staging is not None:
+            sources = [self._source(key) for key in self.valid_keys]
+            staging.stage([self.master_filepath] +
+                          [s for s in sources if s is not None])
+
+    def _init_state(self):
+        ''' Set up everything that is not carried over by pickling or by a
+            fork. Nothing is opened here.'''
+        self._pid = os.getpid()
+        # read chunks with pread rather than through HDF5
+        self._direct = None
+        if self.direct:
+            self._direct = ChunkReader(self.index,
+                                       chunk_cache=self.chunk_cache,
+                                       gain=self._gain)
+        # every thread gets its own file handles, opened on first use and
+        # reopened when the generation changes (see refresh)
+        self._local = threading.local()
+        self._generation = 0
+        # the handles of the threads, which close them when they exit
+        self._handles = weakref.WeakSet()
+        self._lock = threading.Lock()
+        # frames being read, so concurrent requests for one frame share a
+        # single read
+        self._inflight = {}
+        # (shape, chunks, itemsize) of the data files, for sizing caches
+        self._layouts = {}
+        # (data file path, dataset path) of the external link of each key
+        self._links = {}
+        # (frame shape, dtype) of the first data file opened, without an
+        # index
+        self._frame_layout = None
+
+    def __getstate__(self):
+        # pickle by path and configuration, with whatever was already read
+        # about the run, the child reopens the files on first use
+        return {'master_filepath': self.master_filepath,
+                'images_per_file': self.images_per_file, '_md': self._md,
+                'swmr': self.swmr, 'index': self.index,
+                'direct': self.direct, 'raw': self.raw,
+                'memory_budget': self.memory_budget,
+                'on_exceed': self.on_exceed, 'rdcc_nbytes': self.rdcc_nbytes,
+                'rdcc_nslots': self.rdcc_nslots, 'rdcc_w0': self.rdcc_w0,
+                'staging': self.staging, 'chunk_cache': self.chunk_cache,
+                'flatfield': self.flatfield, '_gain': self._gain,
+                '_counts': self._counts}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _check_fork(self):
+        # HDF5 handles opened before a fork must not be used in the child
+        if self._pid != os.getpid():
+            self._init_state()
+
+    def _open(self):
+        self._check_fork()
+        local = self._local
+        if getattr(local, 'generation', None) == self._generation:
+            return local
+        if getattr(local, 'handle', None) is not None:
+            self._close_handle(local.handle)
+        import h5py
+        local.datasets = OrderedDict()
+        # the region of interest this thread last read with read_roi, None
+        # after reading whole frames, and the one the datasets were opened
+        # for
+        local.access = None
+        local.cached_access = None
+        # keys of the datasets opened from staged copies
+        local.staged = set()
+        local.handle = h5py.File(self.master_filepath, 'r', swmr=self.swmr)
         try:
             # Eiger firmware v1.3.0 and onwards
-            self._entry = self._handle['entry']['data']
+            local.entry = local.handle['entry']['data']
         except KeyError:
             # Older firmwares
-            self._entry = self._handle['entry']
+            local.entry = local.handle['entry']
+        local.generation = self._generation
+        # only referenced by this thread's storage, which is dropped when
+        # the thread exits or the handle is replaced
+        local.owner = _HandleOwner()
+        weakref.finalize(local.owner, local.handle.close)
+        with self._lock:
+            self._handles.add(local.handle)
+        return local
+
+    def _close_handle(self, handle):
+        with self._lock:
+            self._handles.discard(handle)
+        handle.close()
+
+    @property
+    def _handle(self):
+        return self._open().handle
+
+    @property
+    def _entry(self):
+        return self._open().entry
 
     @property
     def md(self):
         return self._md
 
+    def _load_gain(self):
+        ''' The flatfield with masked pixels zeroed, as float32, taken from
+            the metadata if it has them, else read from the master file.
+
+            Frames are multiplied by it as they are read: decoded chunks as
+            they are placed with ``direct=True``, else frames converted to
+            float32 by HDF5 as they are read.
+        '''
+        md = self._md or {}
+        flatfield, mask = md.get('flatfield'), md.get('binary_mask')
+        try:
+            if flatfield is None:
+                flatfield = self._handle[FLATFIELD_PATH][()]
+            if mask is None:
+                mask = self._handle[PIXEL_MASK_PATH][()] == 0
+        except KeyError:
+            raise ValueError("{} has no flatfield or pixel mask, it cannot "
+                             "be read with flatfield=True"
+                             .format(self.master_filepath))
+        return np.where(mask, flatfield, 0).astype(np.float32)
+
+    @property
+    def expected_length(self):
+        '''The total number of frames the detector was set up to write,
+        or None if the master file does not record it.'''
+        if self.index is not None and self.index.expected_length is not None:
+            return self.index.expected_length
+        return _expected_length(self._handle)
+
+    def _dataset(self, key):
+        ''' The dataset of one data file, following the external link (and
+            so opening the data file) only on first use.'''
+        local = self._open()
+        if self.rdcc_nbytes == 'auto' and local.cached_access != local.access:
+            # reopen with a chunk cache sized for the new access pattern
+            local.datasets.clear()
+            local.cached_access = local.access
+        datasets = local.datasets
+        staged = None
+        if self.staging is not None and self._source(key) is not None:
+            staged = self.staging.local_path(self._source(key))
+        if key in datasets:
+            datasets.move_to_end(key)
+            if staged is None or key in local.staged:
+                return datasets[key]
+        if staged is None:
+            group, name = local.entry, key
+            local.staged.discard(key)
+        else:
+            # switch to the local copy
+            import h5py
+            group, name = h5py.File(staged, 'r'), self._links[key][1]
+            local.staged.add(key)
+        dataset = datasets[key] = self._open_dataset(group, name, key)
+        if self._frame_layout is None:
+            self._frame_layout = (dataset.shape[1:], dataset.dtype)
+        if len(datasets) > self.max_open_files:
+            datasets.popitem(last=False)
+        return dataset
+
+    def _frame_dataset(self, i):
+        ''' The dataset of the data file holding frame i.'''
+        return self._dataset('data_{:06d}'
+                             .format(1 + i // self.images_per_file))
+
+    def _layout_from(self, i):
+        ''' Learn frame_shape and pixel_type from the data file of frame i,
+            if they are not known yet, so that reading frame i does not also
+            open the first data file.'''
+        if self.index is None and self._frame_layout is None:
+            self._frame_dataset(i)
+
+    def _source(self, key):
+        ''' The path of the data file of key, from its external link, or
+            None if the data is not in a file of its own.'''
+        link = self._links.get(key)
+        if link is None:
+            link = self._entry.get(key, getlink=True)
+            if hasattr(link, 'filename'):
+                link = (os.path.join(os.path.dirname(self.master_filepath),
+                                     link.filename), link.path)
+            else:
+                link = (None, None)
+            self._links[key] = link
+        return link[0]
+
+    def _open_dataset(self, group, name, key):
+        if (self.rdcc_nbytes is None and self.rdcc_nslots is None and
+                self.rdcc_w0 is None):
+            return group[name]
+        import h5py
+        dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+        if self.rdcc_nbytes == 'auto':
+            layout = self._layouts.get(key)
+            if layout is None:
+                # HDF5 shares an open dataset, whatever cache it is opened
+                # with again, so this one is closed before reopening
+                dataset = group[name]
+                layout = self._layouts[key] = (dataset.shape, dataset.chunks,
+                                               dataset.dtype.itemsize)
+                del dataset
+            cache = self._chunk_cache(*layout)
+            if cache is None:
+                return group[name]
+        else:
+            nslots, nbytes, w0 = dapl.get_chunk_cache()
+            cache = (nslots if self.rdcc_nslots is None else self.rdcc_nslots,
+                     nbytes if self.rdcc_nbytes is None else self.rdcc_nbytes,
+                     w0 if self.rdcc_w0 is None else self.rdcc_w0)
+        dapl.set_chunk_cache(*cache)
+        return h5py.Dataset(h5py.h5d.open(group.id, name.encode(), dapl))
+
+    def _chunk_cache(self, shape, chunks, itemsize):
+        ''' The (nslots, nbytes, w0) chunk cache for rdcc_nbytes='auto', or
+            None to keep the default.
+
+            With rdcc_nbytes='auto', whole frames only need the chunks of
+            one frame cached, and only if chunks span several frames.
+            Regions of interest (see ``read_roi``) are usually read
+            repeatedly, so the cache holds every chunk the region touches in
+            the file. Either way the cache is at most ``max_chunk_cache``
+            bytes, but holds at least one chunk.
+        '''
+        if chunks is None:
+            return None
+        chunk_bytes = int(np.prod(chunks)) * itemsize
+        access = self._open().access
+        if access is None:
+            if chunks[0] == 1:
+                # every chunk is read once, caching it is a wasted copy
+                return None
+            bounds = [(0, n) for n in shape[1:]]
+            n_frames = chunks[0]
+            w0 = 1.
+        else:
+            bounds = access
+            n_frames = shape[0]
+            w0 = .75 if self.rdcc_w0 is None else self.rdcc_w0
+        n_chunks = -(-n_frames // chunks[0])
+        for (lo, hi), c in zip(bounds, chunks[1:]):
+            n_chunks *= max(0, (hi - 1) // c - lo // c + 1)
+        n_chunks = max(1, min(n_chunks, self.max_chunk_cache // chunk_bytes))
+        nslots = (self.rdcc_nslots if self.rdcc_nslots is not None
+                  else _prime_at_least(100 * n_chunks))
+        return nslots, n_chunks * chunk_bytes, w0
+
     @property
     def valid_keys(self):
         valid_keys = [key for key in self._entry.keys() if
@@ -51,22 +406,390 @@ class EigerImages(FramesSequence):
         return valid_keys
 
     def get_frame(self, i):
-        dataset = self._entry['data_{:06d}'
-                              .format(1 + (i // self.images_per_file))]
-        img = dataset[i % self.images_per_file]
+        self._check_fork()
+        with self._lock:
+            # [future, number of threads waiting for it]
+            inflight = self._inflight.get(i)
+            if inflight is None:
+                inflight = self._inflight[i] = [Future(), 0]
+                reading = True
+            else:
+                inflight[1] += 1
+                reading = False
+        future = inflight[0]
+        if not reading:
+            # another thread is reading this frame, which nobody changes
+            return self._wrap(future.result().copy(), i)
+        try:
+            img = self.read_frame(i)
+        except BaseException as exc:
+            with self._lock:
+                del self._inflight[i]
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            del self._inflight[i]
+            shared = inflight[1] > 0
+        future.set_result(img)
+        if shared:
+            # the waiting threads copy img, this one gets a copy too
+            img = img.copy()
+        return self._wrap(img, i)
+
+    def _wrap(self, img, i):
+        if self.raw:
+            return img
         return Frame(img, frame_no=i)
 
+    def read_frame(self, i, out=None):
+        ''' Read frame i as a plain array.
+
+            Parameters
+            ----------
+            i : int
+                the frame number
+
+            out : numpy.ndarray, optional
+                C-contiguous array of shape frame_shape to read into, to
+                avoid allocating a new frame
+
+            Returns
+            -------
+            img : numpy.ndarray
+                out, if given
+        '''
+        self._check_fork()
+        if i < 0:
+            i += len(self)
+        if out is None:
+            self._layout_from(i)
+            out = np.empty(tuple(self.frame_shape), dtype=self.dtype)
+        if self._direct is not None:
+            self._direct.read_range(i, i + 1, out[np.newaxis])
+            return out
+        self._open().access = None
+        dataset = self._frame_dataset(i)
+        dataset.read_direct(out, np.s_[i % self.images_per_file])
+        if self._gain is not None:
+            out *= self._gain
+        return out
+
+    def iter_frames(self, start=0, stop=None, n_buffers=2):
+        ''' Iterate over frames without allocating an array per frame.
+
+            Frames are read into a ring of n_buffers arrays: a yielded frame
+            is overwritten n_buffers frames later, copy it to keep it.
+        '''
+        if start < (len(self) if stop is None else stop):
+            self._layout_from(start)
+        return _iter_frames(self, start, stop, n_buffers)
+
+    def iter_blocks(self, block_size, start=0, stop=None, n_buffers=2):
+        ''' Iterate over blocks of consecutive frames.
+
+            Blocks are read with one hyperslab per data file into a ring of
+            n_buffers arrays, as for ``iter_frames``.
+
+            Yields
+            ------
+            first : int
+                the number of the first frame of the block
+
+            block : numpy.ndarray
+                of shape (n, ) + frame_shape, n <= block_size
+        '''
+        if stop is None:
+            stop = len(self)
+        _check_range(self, start, stop)
+        if start < stop:
+            self._layout_from(start)
+        ring = [np.empty((block_size,) + tuple(self.frame_shape),
+                         dtype=self.dtype) for _ in range(n_buffers)]
+        for k, first in enumerate(range(start, stop, block_size)):
+            last = min(stop, first + block_size)
+            block = ring[k % n_buffers][:last - first]
+            self._read_range(first, last, block)
+            yield first, block
+
+    def _read_range(self, start, stop, out, step=1):
+        ''' Read frames range(start, stop, step) into out, one hyperslab per
+            data file.
+        '''
+        self._check_fork()
+        if self._direct is not None:
+            if step == 1:
+                self._direct.read_range(start, stop, out)
+            else:
+                for k, i in enumerate(range(start, stop, step)):
+                    self._direct.read_range(i, i + 1, out[k:k + 1])
+            return
+        self._open().access = None
+        ipf = self.images_per_file
+        i, k = start, 0
+        while i < stop:
+            n = len(range(i, min(stop, (i // ipf + 1) * ipf), step))
+            local = i % ipf
+            dataset = self._frame_dataset(i)
+            dataset.read_direct(out,
+                                np.s_[local:local + (n - 1) * step + 1:step],
+                                np.s_[k:k + n])
+            if self._gain is not None:
+                out[k:k + n] *= self._gain
+            i += n * step
+            k += n
+
+    def read_roi(self, roi, start=0, stop=None, out=None):
+        ''' Read a region of interest of frames [start, stop).
+
+            The region is read through HDF5 (also with ``direct=True``), so
+            that only the chunks it touches are decoded. With
+            ``rdcc_nbytes='auto'`` those chunks stay cached for the next
+            read of the same region.
+
+            Parameters
+            ----------
+            roi : tuple of slice
+                one slice per frame dimension
+
+            out : numpy.ndarray, optional
+                where to write the region of every frame
+
+            Returns
+            -------
+            out : numpy.ndarray
+                of shape (stop - start,) + the region shape
+        '''
+        self._check_fork()
+        if stop is None:
+            stop = len(self)
+        _check_range(self, start, stop)
+        self._layout_from(start)
+        shape = tuple(self.frame_shape)
+        if len(roi) != len(shape):
+            raise ValueError("roi needs one slice per frame dimension, got "
+                             "{} for frames of shape {}".format(roi, shape))
+        roi = tuple(slice(*s.indices(n)) for s, n in zip(roi, shape))
+        if out is None:
+            out = np.empty((stop - start,) +
+                           tuple(len(range(s.start, s.stop, s.step))
+                                 for s in roi), dtype=self.dtype)
+        self._open().access = tuple((s.start, s.stop) for s in roi)
+        ipf = self.images_per_file
+        i = start
+        while i < stop:
+            j = min(stop, (i // ipf + 1) * ipf)
+            dataset = self._frame_dataset(i)
+            local = i % ipf
+            dataset.read_direct(out, (slice(local, local + j - i),) + roi,
+                                np.s_[i - start:j - start])
+            if self._gain is not None:
+                out[i - start:j - start] *= self._gain[roi]
+            i = j
+        return out
+
+    def get_frames(self, key, out=None):
+        ''' Read several frames into one array.
+
+            Slices are read with one hyperslab per data file. Lists of
+            frame numbers are sorted and grouped the same way, then returned
+            in the order asked for.
+
+            Parameters
+            ----------
+            key : int, slice or array-like of int or bool
+                the frames to read
+
+            out : numpy.ndarray, optional
+                where to write the frames
+
+            Returns
+            -------
+            frames : numpy.ndarray
+                of shape (n,) + frame_shape (frame_shape for an int key).
+                If the frames do not fit in ``memory_budget`` and
+                ``on_exceed`` is 'stream', an iterator over blocks of frames
+                instead.
+
+            Raises
+            ------
+            MemoryBudgetExceeded
+                if the frames do not fit in ``memory_budget`` and
+                ``on_exceed`` is 'raise'
+        '''
+        if out is None and not _check_budget(self, key):
+            return self._stream(key)
+        if isinstance(key, (int, np.integer)):
+            frames = self.get_frames([key], out=None if out is None
+                                     else out[np.newaxis])
+            return frames[0]
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(self)))
+            if len(indices):
+                self._layout_from(min(indices))
+        shape = tuple(self.frame_shape)
+        if isinstance(key, slice):
+            if out is None:
+                out = np.empty((len(indices),) + shape, dtype=self.dtype)
+            if indices.step < 0:
+                # read in file order, then reverse
+                indices = indices[::-1]
+                frames = np.empty_like(out)
+                self._read_range(indices.start, indices.stop, frames,
+                                 indices.step)
+                out[...] = frames[::-1]
+            elif len(indices):
+                self._read_range(indices.start, indices.stop, out,
+                                 indices.step)
+            return out
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.nonzero(key)[0]
+        if out is None:
+            out = np.empty((len(key),) + shape, dtype=self.dtype)
+        if len(key):
+            out[...] = _read_frames(self, key)
+        return out
+
+    def nbytes(self, key=None):
+        ''' The size in bytes of the decoded frames selected by key (by
+            default all of them), without reading any.'''
+        return (_selection_len(key, len(self)) *
+                int(np.prod(self.frame_shape)) *
+                np.dtype(self.dtype).itemsize)
+
+    def _stream(self, key):
+        ''' Iterate over the frames selected by key in blocks that fit in
+            the memory budget.'''
+        frame_bytes = self.nbytes(0)
+        block_size = max(1, self.memory_budget // frame_bytes)
+        if isinstance(key, slice):
+            indices = np.arange(len(self))[key]
+        else:
+            indices = np.arange(len(self))[np.asarray(key)]
+        for k in range(0, len(indices), block_size):
+            yield self.get_frames(indices[k:k + block_size])
+
+    def __getitem__(self, key):
+        # slices and lists of frames are lazy pims Slicerators, but
+        # np.asarray of one reads them all: check them against the budget
+        if (not isinstance(key, (int, np.integer)) and
+                not _check_budget(self, key)):
+            return self._stream(key)
+        return super(EigerImages, self).__getitem__(key)
+
+    def __array__(self, dtype=None, copy=None):
+        _check_budget(self, None, allow_stream=False)
+        return np.asarray(self.get_frames(slice(None)), dtype=dtype)
+
     # this uses a trick to check for valid keys before counting
     def __len__(self):
-        return sum(self._entry[k].shape[0] for k in self.valid_keys)
+        if self._counts is None:
+            keys = self.valid_keys
+            if not self.swmr and keys:
+                # avoid opening every data file, the last one tells
+                self._counts = _counts_from_last(
+                    len(keys), self.images_per_file,
+                    self._dataset(keys[-1]).shape[0])
+            if self._counts is None:
+                self._scan(strict=not self.swmr)
+        return sum(self._counts)
+
+    def refresh(self):
+        ''' Re-read the extent of every data file.
+
+            For a run that is still being written, data files that do not
+            exist yet are counted as empty and the scan stops at the first
+            file that is not full. Without SWMR, the master file is reopened
+            so that HDF5 does not serve stale dataset shapes.
+
+            Returns
+            -------
+            length : int
+                the number of frames currently available
+        '''
+        if self._counts is not None:
+            if self.swmr:
+                for k in self.valid_keys[:len(self._counts)]:
+                    self._dataset(k).refresh()
+            else:
+                # every thread reopens its handle on next use
+                self._generation += 1
+        return self._scan(strict=False)
+
+    def _scan(self, strict):
+        counts = []
+        for k in self.valid_keys:
+            try:
+                n = self._dataset(k).shape[0]
+            except KeyError:
+                # linked data file not written yet
+                if strict:
+                    raise
+                break
+            counts.append(n)
+            if n < self.images_per_file:
+                break
+        self._counts = counts
+        return sum(counts)
+
+    def follow(self, start=0, poll_interval=1., timeout=None):
+        ''' Iterate over frames while the run is still being written.
+
+            Frames are yielded as soon as they are available. Iteration ends
+            once ``expected_length`` frames have been read, or when no new
+            frame has appeared for ``timeout`` seconds.
+
+            Parameters
+            ----------
+            start : int, optional
+                the first frame to yield
+
+            poll_interval : float, optional
+                seconds to wait between checks for new frames
+
+            timeout : float or None, optional
+                give up after this many seconds without new frames. If None,
+                wait until ``expected_length`` frames have been read.
+        '''
+        expected = self.expected_length
+        if expected is None and timeout is None:
+            raise ValueError("The master file does not record the number "
+                             "of images, a timeout must be given.")
+        i = start
+        available = self.refresh()
+        last_growth = time.monotonic()
+        while True:
+            while i < available:
+                yield self.get_frame(i)
+                i += 1
+            if expected is not None and i >= expected:
+                return
+            if (timeout is not None and
+                    time.monotonic() - last_growth > timeout):
+                return
+            time.sleep(poll_interval)
+            n = self.refresh()
+            if n > available:
+                available = n
+                last_growth = time.monotonic()
 
     @property
     def frame_shape(self):
-        return self[0].shape
+        if self.index is not None:
+            return self.index.frame_shape
+        if self._frame_layout is None:
+            self._dataset(self.valid_keys[0])
+        return self._frame_layout[0]
 
     @property
     def pixel_type(self):
-        return self[0].dtype
+        if self.flatfield:
+            return np.dtype(np.float32)
+        if self.index is not None:
+            return self.index.dtype
+        if self._frame_layout is None:
+            self._dataset(self.valid_keys[0])
+        return self._frame_layout[1]
 
     @property
     def dtype(self):
@@ -77,7 +800,231 @@ class EigerImages(FramesSequence):
         return self.frame_shape
 
     def close(self):
-        self._handle.close()
+        if self._direct is not None:
+            self._direct.close()
+        with self._lock:
+            handles, self._handles = list(self._handles), weakref.WeakSet()
+            self._generation += 1
+            # drop the datasets every thread opened, which keep their data
+            # files open
+            self._local = threading.local()
+        for handle in handles:
+            handle.close()
+
+
+class _HandleOwner(object):
+    ''' Lives as long as the storage of one thread, a finalizer closes the
+        thread's file handle with it, see EigerImages._open.'''
+    pass
+
+
+def _prime_at_least(n):
+    ''' The smallest prime >= n, HDF5 wants a prime number of cache slots.'''
+    n = max(n, 2)
+    while any(n % k == 0 for k in range(2, int(n ** .5) + 1)):
+        n += 1
+    return n
+
+
+def _images_per_file(master_path):
+    ''' The number of frames in the first data file of a run.'''
+    import h5py
+    with h5py.File(master_path, 'r') as f:
+        try:
+            entry = f['entry']['data']
+        except KeyError:
+            entry = f['entry']
+        keys = sorted(k for k in entry.keys() if k.startswith('data'))
+        return entry[keys[0]].shape[0]
+
+
+class _RunCache(object):
+    ''' Open readers and metadata of the runs a handler used last.
+
+        Handlers resolving one frame per datum hit the same few runs over
+        and over, this saves reopening the master file (and reloading the
+        metadata) every time.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            the number of runs to keep, older readers are closed
+    '''
+    def __init__(self, maxsize=4, staging=None):
+        self.maxsize = maxsize
+        self.staging = staging
+        self._pid = os.getpid()
+        self._readers = OrderedDict()
+        self._md = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # open readers are not carried over, only the configuration
+        return {'maxsize': self.maxsize, 'staging': self.staging}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _get(self, cache, key, make, close=False):
+        if self._pid != os.getpid():
+            # forked, the readers of the parent are not ours to use
+            self.__init__(self.maxsize, self.staging)
+        with self._lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+            value = cache[key] = make()
+            if len(cache) > self.maxsize:
+                _, old = cache.popitem(last=False)
+                if close:
+                    old.close()
+            return value
+
+    def reader(self, master_path, images_per_file=None):
+        ''' An open ``EigerImages`` (without metadata) for a run.
+
+            If images_per_file is None, it is read from the first data file.
+        '''
+        def make():
+            ipf = images_per_file or _images_per_file(master_path)
+            return EigerImages(master_path, ipf, staging=self.staging)
+        return self._get(self._readers, master_path, make, close=True)
+
+    def md(self, master_path, load):
+        ''' The metadata of a run, calling load(master_path) once.'''
+        return self._get(self._md, master_path, lambda: load(master_path))
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            self._md.clear()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    ''' A read would allocate more memory than the reader's budget.'''
+    pass
+
+
+def _selection_len(key, n):
+    ''' The number of frames key selects out of n.'''
+    if key is None:
+        return n
+    if isinstance(key, (int, np.integer)):
+        return 1
+    if isinstance(key, slice):
+        return len(range(*key.indices(n)))
+    key = np.asarray(key)
+    if key.dtype == bool:
+        return int(key.sum())
+    return len(key)
+
+
+def _check_budget(images, key, allow_stream=True):
+    ''' Check that reading key from images fits in its memory budget.
+
+        Returns
+        -------
+        ok : bool
+            False if the read should be streamed instead
+
+        Raises
+        ------
+        MemoryBudgetExceeded
+    '''
+    budget = images.memory_budget
+    if budget is None:
+        return True
+    nbytes = images.nbytes(key)
+    if nbytes <= budget:
+        return True
+    if allow_stream and images.on_exceed == 'stream':
+        return False
+    raise MemoryBudgetExceeded(
+        "Reading these frames needs {} bytes, more than the memory budget "
+        "of {} bytes. Read them in blocks (e.g. with iter_blocks) or raise "
+        "memory_budget.".format(nbytes, budget))
+
+
+def _check_range(images, start, stop):
+    ''' Raise IndexError unless frames [start, stop) are in images.'''
+    if not 0 <= start <= stop <= len(images):
+        raise IndexError("Frames {}:{} out of range for a run of {} "
+                         "frames".format(start, stop, len(images)))
+
+
+def _iter_frames(images, start, stop, n_buffers):
+    ''' Yield frames of images read into a ring of n_buffers arrays.'''
+    if stop is None:
+        stop = len(images)
+    ring = [np.empty(tuple(images.frame_shape), dtype=images.dtype)
+            for _ in range(n_buffers)]
+    for k, i in enumerate(range(start, stop)):
+        yield images.read_frame(i, out=ring[k % n_buffers])
+
+
+def _read_frames(reader, frame_nums):
+    ''' Read the given frames of one run, one read per run of consecutive
+        frames in a data file.
+
+        Returns
+        -------
+        frames : numpy.ndarray
+            in the order of frame_nums
+    '''
+    n = len(reader)
+    frame_nums = np.array([f + n if f < 0 else f for f in frame_nums],
+                          dtype=int)
+    if ((frame_nums < 0) | (frame_nums >= n)).any():
+        raise IndexError("Frame numbers out of range for a run of {} "
+                         "frames".format(n))
+    wanted = np.unique(frame_nums)
+    if len(wanted):
+        reader._layout_from(int(wanted[0]))
+    ipf = reader.images_per_file
+    # split where frames are not consecutive or change data file
+    breaks = np.nonzero((np.diff(wanted) != 1) |
+                        (np.diff(wanted // ipf) != 0))[0] + 1
+    frames = np.empty((len(wanted),) + tuple(reader.frame_shape),
+                      dtype=reader.dtype)
+    for group in np.split(np.arange(len(wanted)), breaks):
+        reader._read_range(int(wanted[group[0]]), int(wanted[group[-1]]) + 1,
+                           frames[group[0]:group[-1] + 1])
+    return frames[np.searchsorted(wanted, frame_nums)]
+
+
+def _bulk_call(handler, master_path, images_per_file, datum_kwargs, stack,
+               n_workers):
+    ''' Resolve many datums for a handler, see ``EigerHandler.bulk_call``.
+    '''
+    datum_kwargs = list(datum_kwargs)
+    results = [None] * len(datum_kwargs)
+    frames = defaultdict(list)
+    runs = {}
+    for pos, kw in enumerate(datum_kwargs):
+        seq_id, frame_num = kw['seq_id'], kw.get('frame_num')
+        if frame_num is None:
+            if seq_id not in runs:
+                runs[seq_id] = handler(seq_id)
+            results[pos] = runs[seq_id]
+        else:
+            frames[seq_id].append((pos, frame_num))
+
+    def read(seq_id):
+        reader = handler._runs.reader(master_path(seq_id), images_per_file)
+        return _read_frames(reader, [f for _, f in frames[seq_id]])
+
+    # runs are read in parallel
+    with ThreadPoolExecutor(n_workers) as executor:
+        for seq_id, arr in zip(frames, executor.map(read, frames)):
+            for (pos, _), img in zip(frames[seq_id], arr):
+                results[pos] = img
+    if stack and results and not runs:
+        shapes = set(img.shape for img in results)
+        if len(shapes) == 1:
+            return np.stack(results)
+    return results
 
 
 class EigerHandler(HandlerBase):
@@ -94,7 +1041,8 @@ class EigerHandler(HandlerBase):
     }
     specs = {'AD_EIGER2', 'AD_EIGER'}
 
-    def __init__(self, fpath, images_per_file=None, frame_per_point=None):
+    def __init__(self, fpath, images_per_file=None, frame_per_point=None,
+                 staging=None):
         ''' Initializer for Eiger handler.
 
             Parameters
@@ -108,6 +1056,9 @@ class EigerHandler(HandlerBase):
             frame_per_point : int, optional. If not set, must set
                 images_per_file
 
+            staging : eiger_io.staging.StagingCache, optional
+                stage the files of every run read on local scratch
+
             This one is backwards compatible for both versions of resources
             saved in databroker. Old resources used 'frame_per_point' as a
             kwarg. Newer resources call this 'images_per_file'.
@@ -134,6 +1085,9 @@ class EigerHandler(HandlerBase):
             print("got images_per_file")
 
         self._images_per_file = images_per_file
+        self.staging = staging
+        self._staged_runs = set()
+        self._runs = _RunCache(staging=staging)
 
     def __call__(self, seq_id, frame_num=None):
         '''
@@ -153,28 +1107,58 @@ class EigerHandler(HandlerBase):
             -------
                 A PIMS FramesSequence of data
         '''
-        master_path = '{}_{}_master.h5'.format(self._base_path, seq_id)
-        with h5py.File(master_path, 'r') as f:
-            md = {k: f[v].value for k, v in self.EIGER_MD_LAYOUT.items()}
-        # the pixel mask from the eiger contains:
-        # 1  -- gap
-        # 2  -- dead
-        # 4  -- under-responsive
-        # 8  -- over-responsive
-        # 16 -- noisy
-        pixel_mask = md['pixel_mask']
-        # pixel_mask[pixel_mask>0] = 1
-        # pixel_mask[pixel_mask==0] = 2
-        # pixel_mask[pixel_mask==1] = 0
-        # pixel_mask[pixel_mask==2] = 1
-        md['binary_mask'] = (pixel_mask == 0)
-        md['framerate'] = 1./md['frame_time']
-        # TODO Return a multi-dimensional PIMS seq.
-        ret = EigerImages(master_path, self._images_per_file, md=md)
+        master_path = self._master_path(seq_id)
+        if self.staging is not None and seq_id not in self._staged_runs:
+            self._staged_runs.add(seq_id)
+            self.staging.stage(self.get_file_list([{'seq_id': seq_id}]))
         if frame_num is not None:
-            ret = ret[frame_num]
+            # a single frame carries no metadata and only needs the data
+            # file it is in
+            reader = self._runs.reader(master_path, self._images_per_file)
+            return reader[frame_num]
+        # a copy, without reading the arrays that are read on access
+        md = self._runs.md(master_path, self._load_md).copy()
+        # TODO Return a multi-dimensional PIMS seq.
+        ret = EigerImages(master_path, self._images_per_file, md=md,
+                          staging=self.staging)
         return ret
 
+    def bulk_call(self, datum_kwargs, stack=True, n_workers=4):
+        ''' Resolve many datums at once.
+
+            Frames are grouped by ``seq_id`` and read in order, with one read
+            for each stretch of consecutive frames in a data file. Runs are
+            read in parallel.
+
+            Parameters
+            ----------
+            datum_kwargs : iterable of dict
+                the datum kwargs (``seq_id`` and optionally ``frame_num``)
+
+            stack : bool, optional
+                if every datum is a single frame, return one stacked array
+
+            n_workers : int, optional
+                the number of runs read at the same time
+
+            Returns
+            -------
+            data : numpy.ndarray or list
+                one entry per datum, in the given order. Datums without a
+                ``frame_num`` give the same as ``__call__``.
+        '''
+        return _bulk_call(self, self._master_path, self._images_per_file,
+                          datum_kwargs, stack, n_workers)
+
+    def _master_path(self, seq_id):
+        return '{}_{}_master.h5'.format(self._base_path, seq_id)
+
+    @classmethod
+    def _load_md(cls, master_path):
+        ''' The metadata of a run, see ``eiger_io.metadata``. Every path of
+            EIGER_MD_LAYOUT must be in the master file.'''
+        return load_metadata(master_path, cls.EIGER_MD_LAYOUT)
+
     def get_file_list(self, datum_kwargs_gen):
         ''' get the file list.
 
@@ -183,7 +1167,8 @@ class EigerHandler(HandlerBase):
         filenames = []
         for dm_kw in datum_kwargs_gen:
             seq_id = dm_kw['seq_id']
-            new_filenames = glob(self._base_path + "_" + str(seq_id) + "*")
+            # not '<base>_<seq_id>*', which also matches longer seq_ids
+            new_filenames = glob('{}_{}_*'.format(self._base_path, seq_id))
             filenames.extend(new_filenames)
 
         return filenames
@@ -199,3 +1184,6 @@ class EigerHandler(HandlerBase):
             sizes.append(os.path.getsize(file))
 
         return sizes
+
+    def close(self):
+        self._runs.close()
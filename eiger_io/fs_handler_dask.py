@@ -1,10 +1,17 @@
 import re
-import h5py
 import os
+from glob import glob
 
-import dask.array as da
+import numpy as np
 from pims import FramesSequence, Frame
 
+# dask and h5py are imported on first use, see fs_handler
+from .fs_handler import (HandlerBase, _RunCache, _bulk_call,
+                         _check_budget, _counts_from_last, _iter_frames,
+                         _selection_len)
+from .index import RunIndex
+from .metadata import load_metadata
+
 
 '''
     The logic is a little convoluted here so here is an explanation:
@@ -15,13 +22,6 @@ from pims import FramesSequence, Frame
                 the handler doesn't do this (it shouldn't need to, the handler should just open the data).
 '''
 
-try:
-    # databroker v0.9.0
-    from databroker.assets.handlers import HandlerBase
-except ImportError:
-    # databroker < v0.9.0
-    from filestore.retrieve import HandlerBase
-
 # wrapper to create a class similar to EigerImages (PIMS version)
 def EigerImagesDask(master_path, _images_per_file, md={}):
     # we don't care about _images_per_file, so we ignore it
@@ -38,7 +38,8 @@ class PIMSDask(FramesSequence):
             - this should be upgraded to allow nested FramesSequences
                 (need to allow for defining axes etc)
     '''
-    def __init__(self, data, md=None):
+    def __init__(self, data, md=None, raw=False, memory_budget=None,
+                 on_exceed='raise', flatfield=False):
         '''
             Initialized a lazy loader for EigerImages
             Parameters
@@ -47,9 +48,33 @@ class PIMSDask(FramesSequence):
                 the data
             md : dict, optional
                 the dictionary of metadata
+            raw : bool, optional
+                return plain numpy arrays rather than pims Frames
+            memory_budget : int, optional
+                the most bytes ``compute`` may return at once
+            on_exceed : {'raise', 'stream'}, optional
+                what ``compute`` does beyond the budget: raise
+                MemoryBudgetExceeded or iterate over blocks of frames
+            flatfield : bool, optional
+                return float32 frames multiplied by ``md['flatfield']``,
+                with the pixels outside ``md['binary_mask']`` zeroed. Every
+                chunk is corrected by the task that reads it.
         '''
+        if on_exceed not in ('raise', 'stream'):
+            raise ValueError("on_exceed must be 'raise' or 'stream'")
+        if flatfield:
+            md = md or {}
+            if 'flatfield' not in md or 'binary_mask' not in md:
+                raise ValueError("flatfield=True needs 'flatfield' and "
+                                 "'binary_mask' in the metadata")
+            data = _apply_gain(data, np.where(md['binary_mask'],
+                                              md['flatfield'], 0))
+        self.flatfield = flatfield
         self._data = data
         self._md = md
+        self.raw = raw
+        self.memory_budget = memory_budget
+        self.on_exceed = on_exceed
 
     @property
     def md(self):
@@ -57,19 +82,81 @@ class PIMSDask(FramesSequence):
 
     def get_frame(self, i):
         # had to return Frame to be friendly with pims_pipeline operations...
-        img = self._data[i].compute()
+        # one frame is a single task, so skip the thread pool (which is also
+        # not usable in a forked child)
+        img = self._data[i].compute(scheduler='synchronous')
+        if self.raw:
+            return img
         return Frame(img, frame_no=i)
 
+    def read_frame(self, i, out=None):
+        ''' Read frame i as a plain array, into out if given.'''
+        if out is None:
+            return self._data[i].compute(scheduler='synchronous')
+        import dask.array as da
+        da.store(self._data[i], out, lock=False, scheduler='synchronous')
+        return out
+
+    def iter_frames(self, start=0, stop=None, n_buffers=2):
+        ''' Iterate over frames without allocating an array per frame.
+
+            Frames are read into a ring of n_buffers arrays: a yielded frame
+            is overwritten n_buffers frames later, copy it to keep it.
+        '''
+        return _iter_frames(self, start, stop, n_buffers)
+
     def __len__(self):
         return len(self._data)
 
+    def nbytes(self, key=None):
+        ''' The size in bytes of the frames selected by key (by default all
+            of them), without computing any.'''
+        return (_selection_len(key, len(self)) *
+                int(np.prod(self.frame_shape)) * self._data.dtype.itemsize)
+
+    def compute(self, key=None):
+        ''' Compute the frames selected by key (all frames by default).
+
+            Returns
+            -------
+            frames : numpy.ndarray
+                or, beyond the memory budget with ``on_exceed='stream'``, an
+                iterator over computed blocks of frames
+
+            Raises
+            ------
+            MemoryBudgetExceeded
+                beyond the memory budget with ``on_exceed='raise'``
+        '''
+        data = self._data if key is None else self._data[key]
+        if not _check_budget(self, key):
+            return self._stream(data)
+        return data.compute()
+
+    def _stream(self, data):
+        block_size = max(1, self.memory_budget // self.nbytes(0))
+        for k in range(0, len(data), block_size):
+            yield data[k:k + block_size].compute()
+
+    def __getitem__(self, key):
+        # as for EigerImages, slices and lists of frames are checked
+        # against the memory budget
+        if (not isinstance(key, (int, np.integer)) and
+                not _check_budget(self, key)):
+            return self._stream(self._data[key])
+        return super(PIMSDask, self).__getitem__(key)
+
+    def __array__(self, dtype=None, copy=None):
+        _check_budget(self, None, allow_stream=False)
+        return np.asarray(self._data.compute(), dtype=dtype)
+
     @property
     def frame_shape(self):
-        return self[0].shape
+        return self._data.shape[1:]
 
     @property
     def pixel_type(self):
-        return self[0].dtype
+        return self._data.dtype
 
     @property
     def dtype(self):
@@ -80,9 +167,30 @@ class PIMSDask(FramesSequence):
         return self.frame_shape
 
     def _to_dask(self):
+        ''' The frames as a dask array.
+
+            The memory budget does not apply: the array is meant to be
+            reduced or written out block by block, computing all of it
+            allocates all of it.
+        '''
         return self._data
 
 
+def _multiply(block, gain):
+    out = np.empty(block.shape, dtype=np.float32)
+    return np.multiply(block, gain, out=out, casting='unsafe')
+
+
+def _apply_gain(data, gain):
+    ''' data multiplied by gain (of the frame shape) as float32, in the
+        tasks computing the chunks of data, which dask fuses with the
+        reads.'''
+    import dask.array as da
+    gain = da.from_array(gain.astype(np.float32), chunks=data.chunks[1:])
+    return da.map_blocks(_multiply, data, gain[np.newaxis],
+                         dtype=np.float32)
+
+
 # TODO : remove this eventually (this should not be used, metadata should be accessed via metadatastore)
 EIGER_MD_LAYOUT = {
     'y_pixel_size': 'entry/instrument/detector/y_pixel_size',
@@ -95,43 +203,124 @@ EIGER_MD_LAYOUT = {
     'count_time': 'entry/instrument/detector/count_time',
     'pixel_mask': 'entry/instrument/detector/detectorSpecific/pixel_mask',
 }
-def _load_eiger_images(master_path):
+
+
+class _LazyDataset(object):
+    ''' Stand-in for the dataset of one data file, to build dask arrays on.
+
+        The external link to the data file is only followed (and the data
+        file opened) on the first read. With a staging cache, the local copy
+        of the data file is read as soon as it is complete.
+    '''
+    def __init__(self, master_path, path, shape, dtype, staging=None):
+        self.master_path = master_path
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.staging = staging
+        self._dataset = None
+        self._pid = None
+        # (data file path, dataset path) of the external link
+        self._link = None
+        self._staged = False
+
+    def __getstate__(self):
+        # pickled by path, the data file is reopened on first read
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        state['_staged'] = False
+        return state
+
+    def __getitem__(self, item):
+        if (self._dataset is None or self._pid != os.getpid() or
+                (not self._staged and self._local_path() is not None)):
+            self._open()
+        return self._dataset[item]
+
+    def _local_path(self):
+        if self.staging is None or self._link is None:
+            return None
+        return self.staging.local_path(self._link[0])
+
+    def _open(self):
+        import h5py
+        self._pid = os.getpid()
+        local = self._local_path()
+        if local is not None:
+            self._dataset = h5py.File(local, 'r')[self._link[1]]
+            self._staged = True
+            return
+        f = h5py.File(self.master_path, 'r')
+        link = f.get(self.path, getlink=True)
+        self._dataset = f[self.path]
+        if hasattr(link, 'filename'):
+            if self.staging is not None:
+                self._link = (os.path.join(os.path.dirname(self.master_path),
+                                           link.filename), link.path)
+            # the data file stays open after the master file is closed
+            f.close()
+        # else the data is in the master file, which stays open with it
+
+
+def _load_eiger_images(master_path, staging=None):
     ''' load images from EIGER data using fpath.
 
         This separation is made from the handler to allow for some code that unfortunately depended
             on this step. (which used to be in EigerImages)
 
+        Data files are not opened until their frames are computed. Their
+        frame counts come from the sidecar index if there is one, else from
+        the first and last data files, every other one being full. Only if
+        the last one does not fit are all data files opened to count frames.
+
         master_path : the full filename of the path
+        staging : eiger_io.staging.StagingCache, optional
+            read data files from their local copies once staged
     '''
+    import dask.array as da
+    import h5py
+    from dask.base import tokenize
+
     with h5py.File(master_path, 'r') as f:
         try:
             # Eiger firmware v1.3.0 and onwards
             _entry = f['entry']['data']
         except KeyError:
             _entry = f['entry']          # Older firmwares
-    
+
         # TODO : perhaps remove the metadata eventually
-        md = dict()
-        md = {k: f[v].value for k, v in EIGER_MD_LAYOUT.items()}
-        # the pixel mask from the eiger contains:
-        # 1  -- gap
-        # 2  -- dead
-        # 4  -- under-responsive
-        # 8  -- over-responsive
-        # 16 -- noisy
-        pixel_mask = md['pixel_mask']
-        md['binary_mask'] = (pixel_mask == 0)
-        md['framerate'] = 1./md['frame_time']
-    
+        # large arrays (pixel_mask, flatfield) are read on first access
+        md = load_metadata(master_path, EIGER_MD_LAYOUT, f)
+
         # TODO : Return a multi-dimensional PIMS seq.
         # this is the logic that creates the linked dask array
+        key_names = sorted(k for k in _entry.keys() if k.startswith('data'))
+        try:
+            index = RunIndex.load(master_path)
+        except Exception:
+            # an index is only a shortcut, the master file has it all
+            index = None
+        if index is not None:
+            counts = index.frame_counts
+            frame_shape, dtype = index.frame_shape, index.dtype
+            chunks = index.chunk_shape
+        else:
+            first = _entry[key_names[0]]
+            frame_shape, dtype = first.shape[1:], first.dtype
+            chunks = first.chunks
+            counts = _counts_from_last(len(key_names), first.shape[0],
+                                       _entry[key_names[-1]].shape[0])
+            if counts is None:
+                counts = [_entry[k].shape[0] for k in key_names]
+
         elements = list()
-        key_names = sorted(list(_entry.keys()))
-        for keyname in key_names:
-            #print(f"{keyname}")
-            val = _entry[keyname]
-            elements.append(da.from_array(val, chunks=val.chunks))
-    
+        for keyname, n in zip(key_names, counts):
+            val = _LazyDataset(master_path, _entry.name + '/' + keyname,
+                               (n,) + tuple(frame_shape), dtype, staging)
+            name = 'eiger-' + tokenize(master_path, keyname, n)
+            elements.append(da.from_array(val, chunks=chunks, name=name))
+
         res = da.concatenate(elements)
 
     return res, md
@@ -140,7 +329,8 @@ def _load_eiger_images(master_path):
 class EigerHandlerDask(HandlerBase):
     specs = {'AD_EIGER2', 'AD_EIGER'}
 
-    def __init__(self, fpath, images_per_file=None, frame_per_point=None):
+    def __init__(self, fpath, images_per_file=None, frame_per_point=None,
+                 staging=None):
         if images_per_file is None and frame_per_point is None:
             errormsg = "images_per_file and frame_per_point both set"
             errormsg += "\n This is likely an error."
@@ -165,29 +355,53 @@ class EigerHandlerDask(HandlerBase):
         # (some keys may be invalid it seems? Only add if this comes up)
         self.images_per_file = images_per_file
         self._base_path = fpath
+        # an eiger_io.staging.StagingCache for the files of the runs read
+        self.staging = staging
+        self._staged_runs = set()
+        self._runs = _RunCache(staging=staging)
 
     # this is on a per event level
     def __call__(self, seq_id, frame_num=None):
         master_path = '{}_{}_master.h5'.format(self._base_path, seq_id)
+        if self.staging is not None and seq_id not in self._staged_runs:
+            self._staged_runs.add(seq_id)
+            self.staging.stage(self.get_file_list([{'seq_id': seq_id}]))
+        if frame_num is not None:
+            # same frame as PIMSDask would compute, but only opening the
+            # data file it is in
+            return self._runs.reader(master_path,
+                                     self.images_per_file)[frame_num]
 
-        data, md = _load_eiger_images(master_path)
+        data, md = _load_eiger_images(master_path, self.staging)
         # PIMS subclass using Dask
         # this gives metadata and also makes the assumption when
         # to run .compute() for dask array
         ret = PIMSDask(data, md=md)
-        if frame_num is not None:
-            ret = ret[frame_num]
         return ret
 
+    def bulk_call(self, datum_kwargs, stack=True, n_workers=4):
+        ''' Resolve many datums at once, see ``EigerHandler.bulk_call``.
+
+            Datums without a ``frame_num`` give a lazy ``PIMSDask``.
+        '''
+        def master_path(seq_id):
+            return '{}_{}_master.h5'.format(self._base_path, seq_id)
+        return _bulk_call(self, master_path, self.images_per_file,
+                          datum_kwargs, stack, n_workers)
+
     def get_file_list(self, datum_kwargs):
         ''' get the file list.
 
-            Receives a list of datum_kwargs for each datum
+            Receives a list of datum_kwargs for each datum. Lists the master
+            and data files of each run, as EigerHandler does.
         '''
         filenames = []
         for dm_kw in datum_kwargs:
             seq_id = dm_kw['seq_id']
-            filename = '{}_{}_master.h5'.format(self._base_path, seq_id)
-            filenames.append(filename)
+            filenames.extend(
+                glob('{}_{}_*'.format(self._base_path, seq_id)))
 
         return filenames
+
+    def close(self):
+        self._runs.close()
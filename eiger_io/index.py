@@ -0,0 +1,251 @@
+''' Sidecar index of an EIGER run, for reopening without touching HDF5.
+
+    Finding out the length of a run means following the external link to
+    every data file. The index records, once, everything the readers need to
+    know about the layout of a run: the frame count, dtype and chunking of
+    every data file, the byte offset and size of every chunk, and the number
+    of frames the detector was set up to write. It is a small ``.npz`` file
+    next to the master file, and is only trusted while the size and mtime of
+    the master and data files it describes are unchanged.
+
+    The metadata of a run is not in the index, ``eiger_io.metadata`` reads
+    it in one pass over the master file.
+
+    To index runs ahead of time::
+
+        python -m eiger_io.index /path/to/*_master.h5
+'''
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .metadata import _expected_length
+
+INDEX_VERSION = 1
+
+
+def index_path(master_path):
+    ''' The default location of the index of a run.'''
+    return master_path + '.index.npz'
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _chunk_table(dsid):
+    ''' (n_chunks, ndim + 3) table of chunk offset, byte offset, size and
+        filter mask, in storage order.'''
+    rows = []
+    if hasattr(dsid, 'chunk_iter'):
+        dsid.chunk_iter(lambda info: rows.append(
+            info.chunk_offset + (info.byte_offset, info.size,
+                                 info.filter_mask)))
+    else:
+        for i in range(dsid.get_num_chunks()):
+            info = dsid.get_chunk_info(i)
+            rows.append(info.chunk_offset + (info.byte_offset, info.size,
+                                             info.filter_mask))
+    return np.array(rows, dtype=np.int64).reshape(
+        len(rows), dsid.rank + 3)
+
+
+def _filters(dsid):
+    dcpl = dsid.get_create_plist()
+    filters = []
+    for i in range(dcpl.get_nfilters()):
+        code, flags, values, name = dcpl.get_filter(i)
+        filters.append([int(code), [int(v) for v in values]])
+    return filters
+
+
+class RunIndex(object):
+    ''' The layout of one run, as stored in its sidecar index.
+
+        Use ``RunIndex.open`` (or ``build``/``load``) rather than creating
+        this directly.
+
+        Attributes
+        ----------
+        files : list of dict
+            one entry per data file, in order, with keys ``key`` (the name in
+            the master file), ``path`` (relative to the master file),
+            ``dataset``, ``nframes``, ``stat``, ``filters``
+
+        dtype : numpy.dtype
+        frame_shape : tuple
+        chunk_shape : tuple
+        expected_length : int or None
+            nimages * ntrigger, as ``EigerImages.expected_length``
+    '''
+    def __init__(self, master_path, meta, chunk_tables):
+        self.master_path = master_path
+        self._meta = meta
+        self._chunk_tables = chunk_tables
+        self.files = meta['files']
+        self.dtype = np.dtype(meta['dtype'])
+        self.frame_shape = tuple(meta['frame_shape'])
+        self.chunk_shape = tuple(meta['chunk_shape'])
+        self.expected_length = meta.get('expected_length')
+
+    @property
+    def frame_counts(self):
+        return [f['nframes'] for f in self.files]
+
+    def __len__(self):
+        return sum(self.frame_counts)
+
+    def data_path(self, i):
+        ''' The absolute path of the i'th data file.'''
+        return os.path.join(os.path.dirname(self.master_path),
+                            self.files[i]['path'])
+
+    def chunk_table(self, i):
+        ''' The chunk table of the i'th data file.
+
+            Returns
+            -------
+            table : numpy.ndarray
+                one row per chunk: the chunk offset (one column per
+                dimension), then byte offset, size and filter mask
+        '''
+        return self._chunk_tables[i]
+
+    @classmethod
+    def build(cls, master_path):
+        ''' Index a run by opening the master and all data files.'''
+        import h5py
+        meta = {'version': INDEX_VERSION, 'stat': _stat(master_path),
+                'files': []}
+        tables = []
+        with h5py.File(master_path, 'r') as f:
+            try:
+                # Eiger firmware v1.3.0 and onwards
+                entry = f['entry']['data']
+            except KeyError:
+                # Older firmwares
+                entry = f['entry']
+            for key in sorted(k for k in entry.keys()
+                              if k.startswith('data')):
+                link = entry.get(key, getlink=True)
+                if not isinstance(link, h5py.ExternalLink):
+                    raise ValueError("{} in {} is not an external link, "
+                                     "cannot index it".format(key,
+                                                              master_path))
+                dataset = entry[key]
+                path = os.path.join(os.path.dirname(master_path),
+                                    link.filename)
+                meta['files'].append({
+                    'key': key, 'path': link.filename,
+                    'dataset': link.path, 'nframes': dataset.shape[0],
+                    'stat': _stat(path), 'filters': _filters(dataset.id)})
+                tables.append(_chunk_table(dataset.id))
+                meta['dtype'] = dataset.dtype.str
+                meta['frame_shape'] = list(dataset.shape[1:])
+                meta['chunk_shape'] = list(dataset.chunks)
+            meta['expected_length'] = _expected_length(f)
+        return cls(master_path, meta, tables)
+
+    def save(self, path=None):
+        ''' Write the index, by default next to the master file.'''
+        if path is None:
+            path = index_path(self.master_path)
+        arrays = {'chunks_{}'.format(i): t
+                  for i, t in enumerate(self._chunk_tables)}
+        # write then rename, so readers never see a partial index. The
+        # temporary file is unique, processes may index a run at once.
+        fd, tmp = tempfile.mkstemp(suffix='.npz',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(self._meta)), **arrays)
+            # mkstemp makes the file private to its owner
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return path
+
+    def is_valid(self):
+        ''' True if the files have not changed since they were indexed.'''
+        try:
+            if _stat(self.master_path) != self._meta['stat']:
+                return False
+            return all(_stat(self.data_path(i)) == f['stat']
+                       for i, f in enumerate(self.files))
+        except OSError:
+            return False
+
+    @classmethod
+    def load(cls, master_path, path=None, validate=True):
+        ''' Read the index of a run.
+
+            Returns
+            -------
+            index : RunIndex or None
+                None if there is no index, if it is out of date, or if it
+                cannot be read (e.g. truncated)
+        '''
+        if path is None:
+            path = index_path(master_path)
+        try:
+            with np.load(path) as npz:
+                meta = json.loads(str(npz['meta']))
+                if meta.get('version') != INDEX_VERSION:
+                    return None
+                tables = [npz['chunks_{}'.format(i)]
+                          for i in range(len(meta['files']))]
+            index = cls(master_path, meta, tables)
+            if validate and not index.is_valid():
+                return None
+        except Exception:
+            # a damaged index is the same as none, it is rebuilt
+            return None
+        return index
+
+    @classmethod
+    def open(cls, master_path, path=None, write=True):
+        ''' Load the index of a run, building it if needed.
+
+            Parameters
+            ----------
+            master_path : str
+                the master file
+
+            path : str, optional
+                the index file, defaults to ``index_path(master_path)``
+
+            write : bool, optional
+                save a newly built index. Failing to save (e.g. in a read
+                only directory) is not an error.
+        '''
+        index = cls.load(master_path, path)
+        if index is None:
+            index = cls.build(master_path)
+            if write:
+                try:
+                    index.save(path)
+                except OSError:
+                    pass
+        return index
+
+
+def build_indexes(master_paths):
+    ''' Build and save the index of every run given.
+
+        Returns
+        -------
+        paths : list of str
+            the index files written
+    '''
+    return [RunIndex.build(p).save() for p in master_paths]
+
+
+if __name__ == '__main__':
+    import sys
+    for p in build_indexes(sys.argv[1:]):
+        print(p)
@@ -0,0 +1,273 @@
+''' Read the metadata of a run in one pass over its master file.
+
+    ``load_metadata`` visits every dataset under ``entry/instrument`` once
+    (``detector``, ``detectorSpecific``, ``beam``, ...), reading the small
+    ones (scalars, strings, short vectors) and only recording where the
+    large ones are, e.g. ``pixel_mask``, ``flatfield`` or the countrate
+    correction table. Those are read the first time they are looked up::
+
+        md = load_metadata('/path/to/run_master.h5')
+        md['threshold_energy'], md['sensor_thickness'], md['ntrigger']
+        md['pixel_mask']        # read now
+
+    Datasets are keyed by name. A name found at several depths (e.g. per
+    module in ``detectorModule_*``) is the shallowest one, ``md.paths``
+    gives the path of every key in the master file.
+
+    Every metadata handed out has arrays of its own: a large array is read
+    once per master file, and each metadata copies it on first access, so
+    changing it in place does not change what other callers get.
+'''
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+INSTRUMENT_PATH = 'entry/instrument'
+# number of frames the detector was asked to record (per trigger)
+NIMAGES_PATH = 'entry/instrument/detector/detectorSpecific/nimages'
+NTRIGGER_PATH = 'entry/instrument/detector/detectorSpecific/ntrigger'
+
+
+def _expected_length(f):
+    ''' nimages * ntrigger from an open master file, or None if the master
+        file does not record it.'''
+    try:
+        nimages = int(f[NIMAGES_PATH][()])
+    except KeyError:
+        return None
+    try:
+        ntrigger = int(f[NTRIGGER_PATH][()])
+    except KeyError:
+        ntrigger = 1
+    return nimages * ntrigger
+
+
+def _binary_mask(get):
+    # the pixel mask from the eiger contains:
+    # 1  -- gap
+    # 2  -- dead
+    # 4  -- under-responsive
+    # 8  -- over-responsive
+    # 16 -- noisy
+    return get('pixel_mask') == 0
+
+
+def _copy(value):
+    ''' A copy of value if it is an array, which could be changed in place.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    return value
+
+
+class EigerMetadata(MutableMapping):
+    ''' The metadata of a run, large arrays being read on first access.
+
+        A mapping with the keys of the metadata dict the handlers returned
+        so far, including the derived 'binary_mask' (True for good pixels)
+        and 'framerate'. Keys can be set and deleted as in a dict.
+
+        Parameters
+        ----------
+        master_path : str
+            the master file, read from for deferred values
+
+        values : dict
+            the values already read
+
+        deferred : dict
+            key -> path in the master file of the values to read on
+            access, or for derived values a function of a getter
+            ``get(key)`` of the values as read
+
+        paths : dict, optional
+            key -> path in the master file of every value read from it
+    '''
+    def __init__(self, master_path, values, deferred, paths=None,
+                 _arrays=None):
+        self.master_path = master_path
+        self.paths = dict(paths or {})
+        self._values = dict(values)
+        self._deferred = dict(deferred)
+        # deferred values once read, shared by copies and never handed
+        # out, every copy gets its own copy of them
+        self._arrays = {} if _arrays is None else _arrays
+        self._own = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key not in self._deferred:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._own:
+                self._own[key] = _copy(self._shared(key))
+            return self._own[key]
+
+    def _shared(self, key):
+        ''' The value of key as read from the master file (or derived from
+            values as read), not to be changed.'''
+        if key in self._values:
+            return self._values[key]
+        with self._lock:
+            if key not in self._arrays:
+                source = self._deferred[key]
+                if callable(source):
+                    self._arrays[key] = source(self._shared)
+                else:
+                    import h5py
+                    with h5py.File(self.master_path, 'r') as f:
+                        self._arrays[key] = f[source][()]
+            return self._arrays[key]
+
+    def __setitem__(self, key, value):
+        self._deferred.pop(key, None)
+        self._own.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key in self._values:
+            del self._values[key]
+        else:
+            del self._deferred[key]
+            self._own.pop(key, None)
+
+    def __contains__(self, key):
+        # without reading deferred values
+        return key in self._values or key in self._deferred
+
+    def __iter__(self):
+        yield from self._values
+        yield from (k for k in self._deferred if k not in self._values)
+
+    def __len__(self):
+        return len(self._values) + len(self._deferred)
+
+    def is_loaded(self, key):
+        ''' Whether the value of key has been read.'''
+        return key in self._values or key in self._arrays
+
+    def copy(self):
+        ''' A copy with arrays of its own, sharing the deferred values read
+            from the master file by either so they are not read again.'''
+        values = {k: _copy(v) for k, v in self._values.items()}
+        md = EigerMetadata(self.master_path, values, self._deferred,
+                           self.paths, self._arrays)
+        with self._lock:
+            md._own = {k: _copy(v) for k, v in self._own.items()}
+        return md
+
+    def __repr__(self):
+        return '<EigerMetadata of {}: {}>'.format(
+            self.master_path,
+            ', '.join(k if self.is_loaded(k) else k + ' (deferred)'
+                      for k in self))
+
+
+def _value(value):
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return value
+
+
+def _harvest(f, layout, max_elements):
+    ''' (values, deferred, paths) of an open master file.'''
+    import h5py
+    values, deferred, paths, depths = {}, {}, {}, {}
+
+    def add(key, path, dataset):
+        paths[key] = path
+        if dataset.size is not None and dataset.size > max_elements:
+            deferred[key] = path
+            values.pop(key, None)
+        else:
+            values[key] = _value(dataset[()])
+            deferred.pop(key, None)
+
+    def visit(name, obj):
+        if not isinstance(obj, h5py.Dataset):
+            return
+        key = name.rsplit('/', 1)[-1]
+        depth = name.count('/')
+        if depths.get(key, depth + 1) > depth:
+            depths[key] = depth
+            add(key, INSTRUMENT_PATH + '/' + name, obj)
+
+    if INSTRUMENT_PATH in f:
+        f[INSTRUMENT_PATH].visititems(visit)
+    # paths that must be there, KeyError otherwise
+    for key, path in (layout or {}).items():
+        if paths.get(key) != path:
+            add(key, path, f[path])
+    if 'pixel_mask' in paths:
+        deferred['binary_mask'] = _binary_mask
+    if 'frame_time' in values:
+        values['framerate'] = 1./values['frame_time']
+    return values, deferred, paths
+
+
+# harvested metadata by (master file, mtime, size, arguments)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+cache_size = 64
+
+
+def load_metadata(master_path, layout=None, f=None, max_elements=16):
+    ''' The metadata of a run, from one traversal of its master file.
+
+        Results are cached while the master file is unchanged, every call
+        returns a copy.
+
+        Parameters
+        ----------
+        master_path : str
+            the master file
+
+        layout : dict, optional
+            key -> path of datasets that must be in the metadata (a
+            KeyError is raised if one is missing), e.g.
+            ``EigerHandler.EIGER_MD_LAYOUT``
+
+        f : h5py.File, optional
+            the master file, if already open
+
+        max_elements : int, optional
+            datasets with more elements are read on first access
+
+        Returns
+        -------
+        md : EigerMetadata
+    '''
+    st = os.stat(master_path)
+    key = (os.path.abspath(master_path), st.st_mtime_ns, st.st_size,
+           tuple(sorted((layout or {}).items())), max_elements)
+    with _cache_lock:
+        md = _cache.get(key)
+        if md is not None:
+            _cache.move_to_end(key)
+            return md.copy()
+    if f is None:
+        import h5py
+        with h5py.File(master_path, 'r') as f:
+            harvested = _harvest(f, layout, max_elements)
+    else:
+        harvested = _harvest(f, layout, max_elements)
+    md = EigerMetadata(master_path, *harvested)
+    with _cache_lock:
+        _cache[key] = md
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return md.copy()
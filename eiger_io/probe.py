@@ -0,0 +1,223 @@
+''' Measure how fast a run can be read on this node.
+
+    Reports, for every reader backend, the time to open the run and the
+    sequential, random and multi-threaded frame throughput, as well as the
+    time to read the metadata and how fast compressed chunks decode::
+
+        eiger-io-probe /path/to/run_master.h5
+        eiger-io-probe /path/to/run --seq-id 3 --threads 1 4 16
+
+    Reads go through the page cache like any other: run the probe on a cold
+    run (or drop caches) to measure the filesystem rather than memory.
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .codecs import can_decode, decode_chunk
+from .fs_handler import EigerHandler, EigerImages, _images_per_file
+from .index import RunIndex
+
+BACKENDS = ('h5py', 'direct', 'dask')
+
+
+def _timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+class _EigerImagesBackend(object):
+    def __init__(self, master_path, direct):
+        index = RunIndex.open(master_path, write=False) if direct else None
+        self.images = EigerImages(master_path, _images_per_file(master_path),
+                                  index=index, direct=direct)
+        if direct and not self.images.direct:
+            raise ValueError("The run cannot be read directly")
+        self.n_frames = len(self.images)
+        self.frame_bytes = (int(np.prod(self.images.frame_shape)) *
+                            self.images.dtype.itemsize)
+
+    def read(self, frames, n_threads):
+        if n_threads == 1:
+            for i in frames:
+                self.images.read_frame(i)
+            return
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(self.images.read_frame, frames))
+
+    def close(self):
+        self.images.close()
+
+
+class _DaskBackend(object):
+    def __init__(self, master_path):
+        from .fs_handler_dask import _load_eiger_images
+        self.data, _ = _load_eiger_images(master_path)
+        self.n_frames = len(self.data)
+        self.frame_bytes = self.data[0].nbytes
+
+    def read(self, frames, n_threads):
+        if n_threads == 1:
+            self.data[frames].compute(scheduler='synchronous')
+        else:
+            self.data[frames].compute(scheduler='threads',
+                                      num_workers=n_threads)
+
+    def close(self):
+        pass
+
+
+def _open_backend(name, master_path):
+    if name == 'dask':
+        return _DaskBackend(master_path)
+    return _EigerImagesBackend(master_path, direct=name == 'direct')
+
+
+def decode_rate(master_path, n_chunks=100):
+    ''' How fast the chunks of the first data file decode, in memory.
+
+        Returns
+        -------
+        rates : tuple of float or None
+            compressed and decoded MB/s, None if the chunks are not
+            compressed or cannot be decoded without HDF5
+    '''
+    index = RunIndex.open(master_path, write=False)
+    filters = index.files[0]['filters']
+    if not filters or not can_decode(filters):
+        return None
+    table = index.chunk_table(0)
+    table = table[table[:, -1] == 0][:n_chunks]
+    with open(index.data_path(0), 'rb') as f:
+        bufs = [os.pread(f.fileno(), int(row[-2]), int(row[-3]))
+                for row in table]
+    _, dt = _timed(lambda: [decode_chunk(buf, filters, index.chunk_shape,
+                                         index.dtype) for buf in bufs])
+    decoded = (len(bufs) * int(np.prod(index.chunk_shape)) *
+               index.dtype.itemsize)
+    return sum(len(buf) for buf in bufs) / dt / 1e6, decoded / dt / 1e6
+
+
+def probe(master_path, n_frames=100, threads=(1, 2, 4, 8),
+          backends=BACKENDS, seed=0):
+    ''' Measure the read performance of a run.
+
+        Parameters
+        ----------
+        master_path : str
+            the master file of the run
+
+        n_frames : int, optional
+            the number of frames read by each measurement
+
+        threads : sequence of int, optional
+            the thread counts to measure random reads with
+
+        backends : sequence of str, optional
+            any of 'h5py' (``EigerImages``), 'direct' (``EigerImages`` with
+            ``direct=True``) and 'dask' (``_load_eiger_images``)
+
+        seed : int, optional
+            seeds the choice of random frames
+
+        Returns
+        -------
+        results : dict
+            'metadata_s', 'decode_MBps' (see ``decode_rate``, only with the
+            'direct' backend, which decodes the same way) and 'backends',
+            mapping each backend to a dict of 'open_s', 'sequential',
+            'random' and 'threads' ({n_threads: rate}), rates being
+            (frames/s, MB/s). A backend, or decoding, that cannot read the
+            run maps to the error message instead.
+    '''
+    rng = np.random.RandomState(seed)
+    _, md_time = _timed(EigerHandler._load_md, master_path)
+    results = {'metadata_s': md_time, 'backends': {}}
+    if 'direct' in backends:
+        # indexing the run opens every data file, only do it if needed
+        try:
+            results['decode_MBps'] = decode_rate(master_path)
+        except (KeyError, OSError, ValueError) as err:
+            results['decode_MBps'] = str(err)
+    for name in backends:
+        try:
+            backend, open_time = _timed(_open_backend, name, master_path)
+        except (ValueError, ImportError) as err:
+            results['backends'][name] = str(err)
+            continue
+        try:
+            n = min(n_frames, backend.n_frames)
+
+            def rate(frames, n_threads=1):
+                _, dt = _timed(backend.read, frames, n_threads)
+                return (len(frames) / dt,
+                        len(frames) * backend.frame_bytes / dt / 1e6)
+            res = {'open_s': open_time,
+                   'sequential': rate(np.arange(n)),
+                   'random': rate(np.sort(rng.choice(backend.n_frames, n,
+                                                     replace=False))),
+                   'threads': {}}
+            for n_threads in threads:
+                frames = rng.choice(backend.n_frames, n, replace=False)
+                res['threads'][n_threads] = rate(frames, n_threads)
+            results['backends'][name] = res
+        finally:
+            backend.close()
+    return results
+
+
+def _report(master_path, results):
+    lines = [master_path,
+             'metadata read: {:.1f} ms'.format(results['metadata_s'] * 1e3)]
+    decode = results.get('decode_MBps', ())
+    if decode is None:
+        lines.append('decode: not compressed or not decodable without HDF5')
+    elif isinstance(decode, str):
+        lines.append('decode: unavailable ({})'.format(decode))
+    elif decode:
+        lines.append('decode: {:.0f} MB/s compressed, {:.0f} MB/s '
+                     'decoded'.format(*decode))
+    for name, res in results['backends'].items():
+        if isinstance(res, str):
+            lines.append('{}: unavailable ({})'.format(name, res))
+            continue
+        lines.append('{}: open {:.1f} ms'.format(name, res['open_s'] * 1e3))
+        for kind in ('sequential', 'random'):
+            lines.append('  {:<12}{:10.1f} frames/s {:10.1f} MB/s'.format(
+                kind, *res[kind]))
+        for n_threads, r in sorted(res['threads'].items()):
+            lines.append('  {:<12}{:10.1f} frames/s {:10.1f} MB/s'.format(
+                '{} threads'.format(n_threads), *r))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='eiger-io-probe',
+        description='Measure how fast an EIGER run can be read.')
+    parser.add_argument('path', help='a master file, or the base path of '
+                        'a run (with --seq-id)')
+    parser.add_argument('--seq-id', help='read <path>_<seq-id>_master.h5')
+    parser.add_argument('-n', '--frames', type=int, default=100,
+                        help='frames read per measurement (default 100)')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='thread counts to measure (default 1 2 4 8)')
+    parser.add_argument('--backend', choices=BACKENDS, action='append',
+                        help='backend to measure, may be repeated '
+                        '(default all)')
+    args = parser.parse_args(argv)
+    master_path = args.path
+    if args.seq_id is not None:
+        master_path = '{}_{}_master.h5'.format(args.path, args.seq_id)
+    results = probe(master_path, args.frames, args.threads,
+                    args.backend or BACKENDS)
+    print(_report(master_path, results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+''' Read and decode EIGER runs in a pool of worker processes.
+
+    h5py serializes every HDF5 call behind one lock, so threads do not help
+    much when reading a run. Here each worker process opens the files
+    itself and writes the frames it reads straight into a shared memory
+    block allocated by the parent, so frames are never pickled.
+
+    usage (for example)::
+
+        with ProcessPoolReader(master_path, images_per_file) as reader:
+            stack = reader.read(0, 1000)
+            sums = reader.map_blocks(np.sum, block_size=100)
+            with reader.read_shared(0, 10000) as frames:
+                total = frames.array.sum(axis=0)
+'''
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .fs_handler import EigerImages
+
+
+# readers opened in this (worker) process, by master file path
+_worker_readers = {}
+
+
+def _worker_reader(master_filepath, images_per_file):
+    key = (master_filepath, images_per_file)
+    if key not in _worker_readers:
+        _worker_readers[key] = EigerImages(master_filepath, images_per_file)
+    return _worker_readers[key]
+
+
+def _read_into_shm(master_filepath, images_per_file, start, stop, shm_name,
+                   offset, shape, dtype):
+    images = _worker_reader(master_filepath, images_per_file)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        images._read_range(start, stop, out[offset:offset + stop - start])
+        del out
+    finally:
+        shm.close()
+
+
+def _map_block(master_filepath, images_per_file, start, stop, func):
+    images = _worker_reader(master_filepath, images_per_file)
+    images._layout_from(start)
+    out = np.empty((stop - start,) + tuple(images.frame_shape),
+                   dtype=images.dtype)
+    images._read_range(start, stop, out)
+    return func(out)
+
+
+class SharedFrames(object):
+    ''' Frames read into shared memory by ``ProcessPoolReader.read_shared``.
+
+        The memory is freed by ``close`` (or on leaving a ``with`` block),
+        after which ``array`` and any view of it must no longer be used.
+
+        Attributes
+        ----------
+        array : numpy.ndarray
+            the frames, backed by the shared memory
+    '''
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def close(self):
+        if self._shm is None:
+            return
+        self.array = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ProcessPoolReader(object):
+    ''' Read frames of one run with a pool of processes.
+
+        Parameters
+        ----------
+        master_filepath : str
+            the master file of the run
+
+        images_per_file : int
+            the number of images in each data file
+
+        n_workers : int, optional
+            the number of processes. Defaults to the number of CPUs.
+
+        block_size : int, optional
+            the most frames a worker reads in one task. Tasks never span
+            data files.
+
+        mp_context : multiprocessing context, optional
+            defaults to 'spawn', forking a process that has HDF5 files open
+            is not safe.
+    '''
+    def __init__(self, master_filepath, images_per_file, n_workers=None,
+                 block_size=64, mp_context=None):
+        self.master_filepath = master_filepath
+        self.images_per_file = images_per_file
+        self.block_size = block_size
+        images = EigerImages(master_filepath, images_per_file)
+        try:
+            self._len = len(images)
+            self.frame_shape = images.frame_shape
+            self.dtype = images.dtype
+        finally:
+            images.close()
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(n_workers,
+                                             mp_context=mp_context)
+
+    def __len__(self):
+        return self._len
+
+    def _blocks(self, start, stop, block_size):
+        ipf = self.images_per_file
+        i = start
+        while i < stop:
+            j = min(stop, i + block_size, (i // ipf + 1) * ipf)
+            yield i, j
+            i = j
+
+    def read(self, start=0, stop=None):
+        ''' Read frames [start, stop) into one array.
+
+            The workers fill a shared memory block, which is copied once
+            into the returned array: this process briefly holds the frames
+            twice. ``read_shared`` avoids the copy.
+
+            Returns
+            -------
+            arr : numpy.ndarray
+                of shape (stop - start,) + frame_shape
+        '''
+        with self.read_shared(start, stop) as frames:
+            return frames.array.copy()
+
+    def read_shared(self, start=0, stop=None):
+        ''' Read frames [start, stop) into shared memory, without copying.
+
+            Returns
+            -------
+            frames : SharedFrames
+                close it (or use it in a ``with`` block) to free the memory
+        '''
+        if stop is None:
+            stop = len(self)
+        if not 0 <= start <= stop <= len(self):
+            raise IndexError("Frames {}:{} out of range for a run of {} "
+                             "frames".format(start, stop, len(self)))
+        shape = (stop - start,) + tuple(self.frame_shape)
+        nbytes = int(np.prod(shape)) * np.dtype(self.dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        frames = SharedFrames(shm, shape, self.dtype)
+        try:
+            futures = [self._executor.submit(
+                _read_into_shm, self.master_filepath, self.images_per_file,
+                i, j, shm.name, i - start, shape, self.dtype)
+                for i, j in self._blocks(start, stop, self.block_size)]
+            for future in futures:
+                future.result()
+        except BaseException:
+            frames.close()
+            raise
+        return frames
+
+    def map_blocks(self, func, start=0, stop=None, block_size=None):
+        ''' Apply func to blocks of frames inside the workers.
+
+            Only the results of func travel back to this process, which
+            makes this the cheapest way to reduce a whole run.
+
+            Parameters
+            ----------
+            func : callable
+                takes an array of shape (n,) + frame_shape. Must be
+                picklable (e.g. defined at module level).
+
+            Returns
+            -------
+            results : list
+                one result per block, in frame order
+        '''
+        if stop is None:
+            stop = len(self)
+        futures = [self._executor.submit(
+            _map_block, self.master_filepath, self.images_per_file, i, j,
+            func)
+            for i, j in self._blocks(start, stop,
+                                     block_size or self.block_size)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,391 @@
+''' Describe EIGER runs as Zarr references, to read them without HDF5.
+
+    ``references`` walks a master file and its data files and returns a
+    reference map in the kerchunk format (version 1): the Zarr metadata of
+    a ``data`` array of every frame of the run and of the ``pixel_mask``,
+    and for every chunk the file, byte offset and length it is stored at.
+    The scalar metadata of ``EIGER_MD_LAYOUT`` is in the group attributes.
+    Paths are written relative to a ``root`` template, the directory of the
+    master file, so that the files can be moved together.
+
+    ``ReferenceImages`` reads frames from a reference map with plain file
+    reads and decodes them in a thread pool (see ``eiger_io.direct``).
+    Zarr tools can read the map through ``fsspec``'s reference filesystem.
+    For bitshuffle/LZ4 data they need the ``eiger_io_h5filter`` numcodecs
+    codec, which is registered here when numcodecs is installed.
+'''
+import base64
+import json
+import os
+import re
+import struct
+
+import numpy as np
+from pims import FramesSequence, Frame
+
+from .codecs import H5Z_FILTER_BSHUF, bslz4_encode, can_decode, \
+    decode_chunk
+from .direct import ChunkReader
+from .fs_handler import EigerHandler
+from .index import RunIndex, _chunk_table, _filters
+
+try:
+    from numcodecs.abc import Codec
+    from numcodecs.compat import ndarray_copy
+    from numcodecs.registry import register_codec
+except ImportError:
+    Codec = None
+
+CODEC_ID = 'eiger_io_h5filter'
+
+
+def _compressor(filters, itemsize):
+    ''' The Zarr compressor of an HDF5 filter pipeline.'''
+    if not can_decode(filters):
+        raise ValueError("Cannot describe the HDF5 filters {} without HDF5"
+                         .format(filters))
+    if not filters:
+        return None
+    code, values = filters[0]
+    if code == 1:
+        return {'id': 'zlib', 'level': values[0] if values else 6}
+    return {'id': CODEC_ID, 'filters': filters, 'itemsize': itemsize}
+
+
+def _filters_of(compressor):
+    ''' The HDF5 filter pipeline of a Zarr compressor, see _compressor.'''
+    if compressor is None:
+        return []
+    if compressor['id'] == 'zlib':
+        return [[1, [compressor['level']]]]
+    if compressor['id'] == CODEC_ID:
+        return compressor['filters']
+    raise ValueError("Unknown compressor {}".format(compressor))
+
+
+def _zarray(shape, chunks, dtype, compressor, fill_value):
+    return json.dumps({
+        'zarr_format': 2, 'shape': list(shape), 'chunks': list(chunks),
+        'dtype': np.dtype(dtype).str, 'compressor': compressor,
+        'filters': None, 'fill_value': fill_value, 'order': 'C'})
+
+
+def _chunk_refs(name, table, ndim, chunks, path, start=0):
+    ''' The chunk references of one dataset, from its chunk table.'''
+    if table[:, -1].any():
+        raise ValueError("{} has chunks stored without their filters, they "
+                         "cannot be described without HDF5".format(path))
+    refs = {}
+    for row in table:
+        origin = (start + row[0],) + tuple(row[1:ndim])
+        key = '.'.join(str(int(o) // c) for o, c in zip(origin, chunks))
+        refs['{}/{}'.format(name, key)] = [path, int(row[-3]), int(row[-2])]
+    return refs
+
+
+def _dataset_refs(name, dataset, path):
+    ''' The Zarr metadata and chunk references of an HDF5 dataset.'''
+    dsid = dataset.id
+    fill = dataset.fillvalue.item()
+    if dataset.chunks is None:
+        offset = dsid.get_offset()
+        zarray = _zarray(dataset.shape, dataset.shape, dataset.dtype, None,
+                         fill)
+        key = '{}/{}'.format(name, '.'.join('0' * dataset.ndim))
+        if offset is None:
+            # not stored in the file on its own, inline it
+            ref = 'base64:' + base64.b64encode(
+                np.ascontiguousarray(dataset[()]).tobytes()).decode()
+        else:
+            ref = [path, offset, dsid.get_storage_size()]
+        return {name + '/.zarray': zarray, key: ref}
+    refs = {name + '/.zarray': _zarray(
+        dataset.shape, dataset.chunks, dataset.dtype,
+        _compressor(_filters(dsid), dataset.dtype.itemsize), fill)}
+    refs.update(_chunk_refs(name, _chunk_table(dsid), dataset.ndim,
+                            dataset.chunks, path))
+    return refs
+
+
+def references(master_path):
+    ''' The reference map of a run.
+
+        Returns
+        -------
+        refs : dict
+            kerchunk references (version 1), with the ``data`` and
+            ``pixel_mask`` arrays and the metadata as group attributes
+
+        Raises
+        ------
+        ValueError
+            if the run cannot be read without HDF5: unsupported filters,
+            chunks spanning two data files or chunks stored unfiltered
+    '''
+    import h5py
+    root = os.path.dirname(os.path.abspath(master_path))
+    index = RunIndex.open(master_path, write=False)
+    chunks = index.chunk_shape
+    compressor = _compressor(index.files[0]['filters'], index.dtype.itemsize)
+    refs = {'.zgroup': json.dumps({'zarr_format': 2})}
+    start = 0
+    files = []
+    for i, f in enumerate(index.files):
+        if start % chunks[0] or f['filters'] != index.files[0]['filters']:
+            raise ValueError("Data file {} does not continue the chunks of "
+                             "the previous ones".format(f['path']))
+        path = '{{root}}/' + f['path']
+        refs.update(_chunk_refs('data', index.chunk_table(i),
+                                len(chunks), chunks, path, start))
+        files.append({'path': path, 'dataset': f['dataset'],
+                      'nframes': f['nframes']})
+        start += f['nframes']
+    with h5py.File(master_path, 'r') as f:
+        try:
+            # Eiger firmware v1.3.0 and onwards
+            entry = f['entry']['data']
+        except KeyError:
+            # Older firmwares
+            entry = f['entry']
+        fill = entry[index.files[0]['key']].fillvalue.item()
+        mask_path = EigerHandler.EIGER_MD_LAYOUT['pixel_mask']
+        refs.update(_dataset_refs(
+            'pixel_mask', f[mask_path],
+            '{{root}}/' + os.path.basename(master_path)))
+        attrs = {k: f[v][()].item()
+                 for k, v in EigerHandler.EIGER_MD_LAYOUT.items()
+                 if k != 'pixel_mask'}
+    refs['data/.zarray'] = _zarray((start,) + index.frame_shape, chunks,
+                                   index.dtype, compressor, fill)
+    attrs['files'] = files
+    refs['.zattrs'] = json.dumps(attrs)
+    return {'version': 1, 'templates': {'root': root}, 'refs': refs}
+
+
+def write_references(master_path, dest=None):
+    ''' Write the reference map of a run as JSON, by default to
+        ``<master>.refs.json``.
+
+        Returns
+        -------
+        dest : str
+    '''
+    if dest is None:
+        dest = master_path + '.refs.json'
+    # before opening dest, which is not written on errors
+    refs = references(master_path)
+    with open(dest, 'w') as f:
+        json.dump(refs, f)
+    return dest
+
+
+_TEMPLATE = re.compile(r'{{(\w+)}}')
+
+
+class ReferenceImages(FramesSequence):
+    ''' The frames of a run, read through its reference map.
+
+        Offers the ``EigerImages`` API (``get_frame``, ``read_frame``,
+        ``get_frames`` with slices), and ``_to_dask`` like ``PIMSDask``.
+
+        Parameters
+        ----------
+        refs : str or dict
+            the reference map, or the JSON file holding it
+
+        root : str, optional
+            the directory of the files, if they moved since the map was
+            written
+
+        n_workers : int, optional
+            the number of threads decoding the chunks of a read
+
+        raw : bool, optional
+            return plain numpy arrays rather than pims Frames
+
+        chunk_cache : eiger_io.direct.ChunkCache, optional
+            where to keep the compressed chunks read
+    '''
+    def __init__(self, refs, root=None, n_workers=4, raw=False,
+                 chunk_cache=None):
+        if isinstance(refs, str):
+            with open(refs) as f:
+                refs = json.load(f)
+        templates = dict(refs.get('templates', {}))
+        if root is not None:
+            templates['root'] = root
+        self._templates = templates
+        self._refs = refs['refs']
+        self.raw = raw
+        zarray = json.loads(self._refs['data/.zarray'])
+        attrs = json.loads(self._refs['.zattrs'])
+        filters = _filters_of(zarray['compressor'])
+        if not can_decode(filters):
+            raise ImportError("The decoder of {} is not installed"
+                              .format(zarray['compressor']))
+        chunks = tuple(zarray['chunks'])
+        tables, files, start = [], [], 0
+        for f in attrs.pop('files'):
+            path = self._path(f['path'])
+            tables.append(self._chunk_table(f['path'], start, chunks))
+            files.append({'path': path, 'dataset': f['dataset'],
+                          'nframes': f['nframes'], 'filters': filters,
+                          'fillvalue': zarray['fill_value']})
+            start += f['nframes']
+        meta = {'files': files, 'dtype': zarray['dtype'],
+                'frame_shape': zarray['shape'][1:], 'chunk_shape': chunks,
+                'md': attrs}
+        self._reader = ChunkReader(RunIndex(os.path.join(templates['root'],
+                                                         'refs'),
+                                            meta, tables), n_workers,
+                                   chunk_cache)
+        md = dict(attrs)
+        md['pixel_mask'] = self._read_array('pixel_mask')
+        md['binary_mask'] = (md['pixel_mask'] == 0)
+        md['framerate'] = 1./md['frame_time']
+        self._md = md
+
+    def _path(self, path):
+        return _TEMPLATE.sub(lambda m: self._templates[m.group(1)], path)
+
+    def _chunk_table(self, path, start, chunks):
+        ''' The chunk table of one data file (as ``RunIndex.chunk_table``),
+            from the references to it.'''
+        rows = []
+        for key, ref in self._refs.items():
+            if not key.startswith('data/') or key.endswith('.zarray') or \
+                    ref[0] != path:
+                continue
+            origin = [int(k) * c for k, c in
+                      zip(key[len('data/'):].split('.'), chunks)]
+            origin[0] -= start
+            rows.append(origin + [ref[1], ref[2], 0])
+        return np.array(rows, dtype=np.int64).reshape(len(rows),
+                                                      len(chunks) + 3)
+
+    def _read_array(self, name):
+        ''' Read a whole (small) array of the map.'''
+        zarray = json.loads(self._refs[name + '/.zarray'])
+        filters = _filters_of(zarray['compressor'])
+        shape, chunks = zarray['shape'], zarray['chunks']
+        out = np.full(shape, zarray['fill_value'], dtype=zarray['dtype'])
+        for key, ref in self._refs.items():
+            if not key.startswith(name + '/') or key.endswith('.zarray'):
+                continue
+            if isinstance(ref, str):
+                buf = base64.b64decode(ref[len('base64:'):])
+            else:
+                with open(self._path(ref[0]), 'rb') as f:
+                    buf = os.pread(f.fileno(), ref[2], ref[1])
+            arr = decode_chunk(buf, filters, chunks, out.dtype)
+            origin = [int(k) * c for k, c in
+                      zip(key[len(name) + 1:].split('.'), chunks)]
+            dst = tuple(slice(o, min(o + c, n))
+                        for o, c, n in zip(origin, chunks, shape))
+            out[dst] = arr[tuple(slice(0, s.stop - s.start) for s in dst)]
+        return out
+
+    @property
+    def md(self):
+        return self._md
+
+    def get_frame(self, i):
+        img = self.read_frame(i)
+        if self.raw:
+            return img
+        return Frame(img, frame_no=i)
+
+    def read_frame(self, i, out=None):
+        ''' Read frame i as a plain array, into out if given.'''
+        if i < 0:
+            i += len(self)
+        return self._reader.read_range(
+            i, i + 1, None if out is None else out[np.newaxis])[0]
+
+    def get_frames(self, key, out=None):
+        ''' Read a slice of frames into one array.'''
+        indices = range(*key.indices(len(self)))
+        if indices.step == 1:
+            return self._reader.read_range(indices.start, indices.stop, out)
+        if out is None:
+            out = np.empty((len(indices),) + self.frame_shape,
+                           dtype=self.dtype)
+        for k, i in enumerate(indices):
+            self.read_frame(i, out[k])
+        return out
+
+    def __len__(self):
+        return len(self._reader)
+
+    @property
+    def frame_shape(self):
+        return self._reader.frame_shape
+
+    @property
+    def pixel_type(self):
+        return self._reader.dtype
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    @property
+    def shape(self):
+        return self.frame_shape
+
+    def _to_dask(self):
+        import dask.array as da
+        return da.from_array(_FrameArray(self._reader),
+                             chunks=(1,) + self.frame_shape)
+
+    def close(self):
+        self._reader.close()
+
+
+class _FrameArray(object):
+    ''' Array-like view of a ChunkReader, for dask.'''
+    def __init__(self, reader):
+        self.reader = reader
+        self.shape = (len(reader),) + tuple(reader.frame_shape)
+        self.dtype = reader.dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, item):
+        # dask only asks for tuples of slices
+        start, stop, step = item[0].indices(self.shape[0])
+        block = self.reader.read_range(start, stop)[::step]
+        return block[(slice(None),) + tuple(item[1:])]
+
+
+if Codec is not None:
+    class H5FilterCodec(Codec):
+        ''' numcodecs codec decoding chunks written by the EIGER HDF5
+            filters, see ``eiger_io.codecs``.'''
+        codec_id = CODEC_ID
+
+        def __init__(self, filters, itemsize):
+            self.filters = filters
+            self.itemsize = itemsize
+
+        def decode(self, buf, out=None):
+            buf = memoryview(buf).cast('B')
+            # both filters start with the big-endian decoded size
+            nbytes, = struct.unpack('>Q', bytes(buf[:8]))
+            arr = decode_chunk(buf, self.filters,
+                               (nbytes // self.itemsize,),
+                               'u{}'.format(self.itemsize))
+            return ndarray_copy(arr, out)
+
+        def encode(self, buf):
+            code, values = self.filters[0]
+            if code != H5Z_FILTER_BSHUF:
+                raise NotImplementedError("Only bitshuffle/LZ4 encoding is "
+                                          "supported")
+            arr = np.frombuffer(buf, dtype='u{}'.format(self.itemsize))
+            return bslz4_encode(arr)
+
+        def get_config(self):
+            return {'id': self.codec_id, 'filters': self.filters,
+                    'itemsize': self.itemsize}
+
+    register_codec(H5FilterCodec)
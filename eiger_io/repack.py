@@ -0,0 +1,287 @@
+''' Repack EIGER runs into a single, read-optimized chunked store.
+
+    The detector writes one chunk per frame, spread over many data files.
+    That is fine for reading whole frames but very slow for pixel time
+    series, which touch every chunk of the run. ``repack`` rewrites one run
+    (or several, concatenated along the frame axis) into one HDF5 file or
+    Zarr array with the chunking of your choice, e.g. time tiles of
+    (1000, 64, 64). ``RepackedImages`` reads it back.
+
+    The chunks are compressed in a pool of threads and written as they are,
+    so compression is parallel even though HDF5 writes are not. Frames are
+    read ``chunks[0]`` at a time, in bands of rows that fit in
+    ``max_memory`` bytes, e.g. 64 rows of 1000 frames of a 16M detector
+    (1 GB). Every band decodes the frames again, so a larger budget means
+    fewer passes over the source.
+
+    In the HDF5 layout the data is in ``entry/data/data`` and the metadata
+    is written at the same paths as in the master file, so
+    ``EigerHandler.EIGER_MD_LAYOUT`` applies. A Zarr store is a directory
+    with ``data`` and ``pixel_mask`` arrays, the scalar metadata is in the
+    attributes of ``data``.
+
+    zarr is only needed for Zarr stores.
+'''
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import dask.array as da
+import h5py
+import numpy as np
+from pims import FramesSequence, Frame
+
+from .fs_handler import EigerHandler, EigerImages, _images_per_file
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+DATA_PATH = 'entry/data/data'
+# start frame of each repacked run, for multi sequence stores
+OFFSETS_PATH = 'entry/data/run_offsets'
+
+
+def _tiles(shape, chunks):
+    ''' Yield the slices of every chunk of a (frames, y, x) block.'''
+    ranges = [range(0, n, c) for n, c in zip(shape[1:], chunks[1:])]
+    for y, x in product(*ranges):
+        yield (slice(None), slice(y, y + chunks[1]), slice(x, x + chunks[2]))
+
+
+def _encode_chunk(tile, chunks, level):
+    # HDF5 stores edge chunks at full size
+    if tile.shape != tuple(chunks):
+        padded = np.zeros(chunks, dtype=tile.dtype)
+        padded[tuple(slice(0, n) for n in tile.shape)] = tile
+        tile = padded
+    raw = np.ascontiguousarray(tile).tobytes()
+    if level:
+        return zlib.compress(raw, level)
+    return raw
+
+
+def repack(master_paths, dest, chunks=(1000, 64, 64), fmt='hdf5',
+           compression_level=4, n_workers=4, images_per_file=None,
+           max_memory=1 << 30):
+    ''' Rewrite one or more runs into a single chunked store.
+
+        Parameters
+        ----------
+        master_paths : str or list of str
+            master file(s). Several runs are concatenated in the given order.
+
+        dest : str
+            the HDF5 file or the Zarr directory to create
+
+        chunks : tuple of 3 ints, optional
+            (frames, y, x) chunk shape of the output
+
+        fmt : {'hdf5', 'zarr'}, optional
+            the output format
+
+        compression_level : int, optional
+            the gzip level of the HDF5 output (0 to disable compression).
+            Zarr stores use the zarr default compressor.
+
+        n_workers : int, optional
+            the number of compression threads
+
+        images_per_file : int, optional
+            read from the first data file if not given
+
+        max_memory : int, optional
+            the most bytes of frames held at a time. At least ``chunks[1]``
+            rows of ``chunks[0]`` frames are, whatever the budget.
+
+        Returns
+        -------
+        dest : str
+    '''
+    if isinstance(master_paths, str):
+        master_paths = [master_paths]
+    if fmt not in ('hdf5', 'zarr'):
+        raise ValueError("Unknown format {!r}, expected 'hdf5' or 'zarr'"
+                         .format(fmt))
+    if fmt == 'zarr' and zarr is None:
+        raise ImportError("zarr is required to write Zarr stores.")
+    runs = [EigerImages(p, images_per_file or _images_per_file(p))
+            for p in master_paths]
+    try:
+        lengths = [len(r) for r in runs]
+        frame_shape = tuple(runs[0].frame_shape)
+        dtype = runs[0].dtype
+        shape = (sum(lengths),) + frame_shape
+        chunks = tuple(min(c, n) for c, n in zip(chunks, shape))
+        md = EigerHandler._load_md(master_paths[0])
+        offsets = np.cumsum([0] + lengths[:-1])
+        # rows read at a time, a multiple of the chunk rows
+        row_bytes = (chunks[0] * int(np.prod(frame_shape[1:])) *
+                     np.dtype(dtype).itemsize)
+        band = max(1, max_memory // row_bytes // chunks[1]) * chunks[1]
+        blocks = _time_blocks(runs, offsets, chunks, dtype, frame_shape, band)
+        with ThreadPoolExecutor(n_workers) as executor:
+            if fmt == 'hdf5':
+                _repack_hdf5(blocks, dest, shape, chunks, dtype, md, offsets,
+                             compression_level, executor)
+            else:
+                _repack_zarr(blocks, dest, shape, chunks, dtype, md, offsets,
+                             executor)
+    finally:
+        for r in runs:
+            r.close()
+    return dest
+
+
+def _time_blocks(runs, offsets, chunks, dtype, frame_shape, band):
+    ''' Yield (start, row, block) for blocks of chunks[0] frames across all
+        runs, band rows from row at a time.'''
+    n_frames = int(offsets[-1]) + len(runs[-1])
+    n_rows = frame_shape[0]
+    row_size = int(np.prod(frame_shape[1:]))
+    # reads need contiguous blocks
+    buf = np.empty(chunks[0] * min(band, n_rows) * row_size, dtype=dtype)
+    for start in range(0, n_frames, chunks[0]):
+        stop = min(n_frames, start + chunks[0])
+        for row in range(0, n_rows, band):
+            rows = slice(row, min(n_rows, row + band))
+            shape = (stop - start, rows.stop - row) + frame_shape[1:]
+            block = buf[:int(np.prod(shape))].reshape(shape)
+            for run, offset in zip(runs, offsets):
+                i = max(start, int(offset))
+                j = min(stop, int(offset) + len(run))
+                if i >= j:
+                    continue
+                out = block[i - start:j - start]
+                if band >= n_rows:
+                    run._read_range(i - offset, j - offset, out)
+                else:
+                    run.read_roi((rows, slice(None)), i - offset, j - offset,
+                                 out)
+            yield start, row, block
+
+
+def _repack_hdf5(blocks, dest, shape, chunks, dtype, md, offsets, level,
+                 executor):
+    with h5py.File(dest, 'w') as f:
+        dset = f.create_dataset(DATA_PATH, shape=shape, dtype=dtype,
+                                chunks=chunks,
+                                compression='gzip' if level else None,
+                                compression_opts=level or None)
+        f[OFFSETS_PATH] = offsets
+        for k, v in EigerHandler.EIGER_MD_LAYOUT.items():
+            f[v] = md[k]
+        for start, row, block in blocks:
+            tiles = list(_tiles(block.shape, chunks))
+            blobs = executor.map(
+                lambda t: _encode_chunk(block[t], chunks, level), tiles)
+            for t, blob in zip(tiles, blobs):
+                dset.id.write_direct_chunk(
+                    (start, row + t[1].start, t[2].start), blob)
+
+
+def _repack_zarr(blocks, dest, shape, chunks, dtype, md, offsets, executor):
+    arr = zarr.open_array(os.path.join(dest, 'data'), mode='w', shape=shape,
+                          chunks=chunks, dtype=dtype)
+    mask = zarr.open_array(os.path.join(dest, 'pixel_mask'), mode='w',
+                           shape=md['pixel_mask'].shape,
+                           dtype=md['pixel_mask'].dtype)
+    mask[...] = md['pixel_mask']
+    attrs = {k: np.asarray(md[k]).item()
+             for k in EigerHandler.EIGER_MD_LAYOUT if k != 'pixel_mask'}
+    attrs['run_offsets'] = [int(o) for o in offsets]
+    arr.attrs.update(attrs)
+    for start, row, block in blocks:
+        def write(t, start=start, row=row, block=block):
+            rows = slice(row + t[1].start, row + t[1].stop)
+            arr[start:start + len(block), rows, t[2]] = block[t]
+        # chunk aligned regions, so the writes do not overlap
+        list(executor.map(write, _tiles(block.shape, chunks)))
+
+
+class RepackedImages(FramesSequence):
+    ''' Read a store written by ``repack`` (or ``vds.write_vds``).
+
+        Offers the ``EigerImages`` API, plus ``pixel_series`` for the reads
+        the store is laid out for and ``_to_dask`` like ``PIMSDask``. The
+        frames of a (points, frames, y, x) dataset are numbered point by
+        point.
+
+        Parameters
+        ----------
+        path : str
+            the HDF5 file or Zarr directory
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._handle = None
+        if os.path.isdir(path):
+            if zarr is None:
+                raise ImportError("zarr is required to read Zarr stores.")
+            self._data = zarr.open_array(os.path.join(path, 'data'),
+                                         mode='r')
+            md = dict(self._data.attrs)
+            self.run_offsets = md.pop('run_offsets')
+            md['pixel_mask'] = zarr.open_array(
+                os.path.join(path, 'pixel_mask'), mode='r')[...]
+        else:
+            self._handle = h5py.File(path, 'r')
+            self._data = self._handle[DATA_PATH]
+            self.run_offsets = [int(o) for o in self._handle[OFFSETS_PATH][()]]
+            md = {k: self._handle[v][()]
+                  for k, v in EigerHandler.EIGER_MD_LAYOUT.items()}
+        md['binary_mask'] = (md['pixel_mask'] == 0)
+        md['framerate'] = 1./md['frame_time']
+        self._md = md
+
+    @property
+    def md(self):
+        return self._md
+
+    def _frame_index(self, i):
+        if self._data.ndim == 4:
+            return divmod(i, self._data.shape[1])
+        return i
+
+    def get_frame(self, i):
+        return Frame(self._data[self._frame_index(i)], frame_no=i)
+
+    def pixel_series(self, y, x, start=0, stop=None):
+        ''' The time series of one pixel (or of a region, given slices).'''
+        if self._data.ndim == 4:
+            series = self._data[:, :, y, x]
+            return series.reshape((-1,) + series.shape[2:])[start:stop]
+        return self._data[start:stop, y, x]
+
+    def __len__(self):
+        return int(np.prod(self._data.shape[:-2]))
+
+    @property
+    def frame_shape(self):
+        return tuple(self._data.shape[-2:])
+
+    @property
+    def pixel_type(self):
+        return self._data.dtype
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    @property
+    def shape(self):
+        return self.frame_shape
+
+    def _to_dask(self):
+        # a virtual dataset has no chunks of its own, take one per frame
+        chunks = (self._data.chunks or
+                  (1,) * (self._data.ndim - 2) + self.frame_shape)
+        data = da.from_array(self._data, chunks=chunks)
+        return data.reshape((len(self),) + self.frame_shape)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
@@ -0,0 +1,245 @@
+''' Stage data files on local scratch, for runs on network filesystems.
+
+    Random frame reads from GPFS or NFS pay the network latency on every
+    chunk. A ``StagingCache`` copies the files of a run to a local scratch
+    directory in the background, with large sequential reads, and the
+    readers (``EigerImages``, ``_load_eiger_images`` and the handlers, given
+    ``staging=``) switch to the local copy of every data file as soon as it
+    is complete. Copies are kept for later analyses of the same run, the
+    least recently used being removed when the scratch quota is reached.
+
+    A copy is only used while its size and mtime match the original.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class StagingCache(object):
+    ''' Local copies of files, within a disk quota.
+
+        Parameters
+        ----------
+        scratch_dir : str
+            where to keep the copies, created if needed
+
+        quota : int
+            the most bytes of copies to keep
+
+        n_workers : int, optional
+            the number of files copied at the same time
+
+        Attributes
+        ----------
+        block_size : int
+            the size of the reads copying a file
+    '''
+    block_size = 1 << 26
+
+    def __init__(self, scratch_dir, quota, n_workers=2):
+        self.scratch_dir = scratch_dir
+        self.quota = quota
+        self.n_workers = n_workers
+        os.makedirs(scratch_dir, exist_ok=True)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(n_workers)
+        # local path -> size of every copy, least recently used first
+        self._copies = OrderedDict()
+        # original -> local path, for copies checked to be up to date
+        self._verified = {}
+        # original -> Future of copies being made
+        self._pending = {}
+        # local paths of the copies being made, which are not evicted
+        self._copying = set()
+        # bytes of the copies, and of those being made
+        self._used = 0
+        self._scan()
+
+    def __getstate__(self):
+        return {'scratch_dir': self.scratch_dir, 'quota': self.quota,
+                'n_workers': self.n_workers}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _scan(self):
+        ''' Pick up the copies made earlier, oldest use first, removing the
+            least recently used ones beyond the quota.'''
+        copies = []
+        for dirpath, _, filenames in os.walk(self.scratch_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith('.part'):
+                    # left by an interrupted copy
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                copies.append((st.st_atime, path, st.st_size))
+        for _, path, size in sorted(copies):
+            self._copies[path] = size
+            self._used += size
+        while self._used > self.quota:
+            path, size = self._copies.popitem(last=False)
+            self._used -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _local(self, path):
+        ''' Where the copy of path goes: one directory per original
+            directory, so that files keep their names.'''
+        path = os.path.abspath(path)
+        dirname, basename = os.path.split(path)
+        digest = hashlib.sha1(dirname.encode()).hexdigest()[:16]
+        return os.path.join(self.scratch_dir, digest, basename)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # the copying threads were not forked
+            self.__init__(self.scratch_dir, self.quota, self.n_workers)
+
+    def local_path(self, path):
+        ''' The up to date local copy of path, or None.
+
+            Cheap enough to call on every read.
+        '''
+        self._check_fork()
+        with self._lock:
+            local = self._verified.get(path)
+            if local is not None:
+                self._copies.move_to_end(local)
+                return local
+            if path in self._pending:
+                return None
+        local = self._local(path)
+        try:
+            st_local = os.stat(local)
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (st_local.st_size != st.st_size or
+                st_local.st_mtime_ns != st.st_mtime_ns):
+            return None
+        with self._lock:
+            if local not in self._copies:
+                # removed since it was checked
+                return None
+            self._verified[path] = local
+            self._copies.move_to_end(local)
+        # record the use for the next session
+        os.utime(local, ns=(time.time_ns(), st.st_mtime_ns))
+        return local
+
+    def stage(self, paths):
+        ''' Copy files to scratch in the background.
+
+            Files already staged or being staged are skipped, as are files
+            larger than the quota.
+
+            Returns
+            -------
+            futures : list of concurrent.futures.Future
+                one per path, giving the local path (None if the file is not
+                staged)
+        '''
+        self._check_fork()
+        futures = []
+        for path in paths:
+            local = self.local_path(path)
+            with self._lock:
+                future = self._pending.get(path)
+                if future is None:
+                    future = Future()
+                    if local is None:
+                        self._pending[path] = future
+                        self._executor.submit(self._copy, path, future)
+                    else:
+                        future.set_result(local)
+            futures.append(future)
+        return futures
+
+    def _copy(self, path, future):
+        local = self._local(path)
+        reserved = False
+        try:
+            st = os.stat(path)
+            reserved = self._reserve(st.st_size, local)
+            if not reserved:
+                with self._lock:
+                    self._pending.pop(path, None)
+                future.set_result(None)
+                return
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            tmp = local + '.part'
+            with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(src.fileno(), 0, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
+                while True:
+                    buf = src.read(self.block_size)
+                    if not buf:
+                        break
+                    dst.write(buf)
+            os.utime(tmp, ns=(time.time_ns(), st.st_mtime_ns))
+            os.replace(tmp, local)
+        except BaseException as exc:
+            with self._lock:
+                self._pending.pop(path, None)
+                if reserved:
+                    self._copying.discard(local)
+                    self._used -= self._copies.pop(local)
+            future.set_exception(exc)
+            return
+        with self._lock:
+            self._verified[path] = local
+            self._pending.pop(path, None)
+            self._copying.discard(local)
+        future.set_result(local)
+
+    def _reserve(self, size, local):
+        ''' Make room for a copy of size bytes at local, evicting the least
+            recently used copies. False if it cannot fit.'''
+        if size > self.quota:
+            return False
+        evicted = []
+        with self._lock:
+            busy = sum(self._copies[p] for p in self._copying)
+            if busy + size > self.quota:
+                # cannot fit until other copies are done
+                return False
+            old = self._copies.pop(local, None)
+            if old is not None:
+                # an out of date copy of the same file
+                self._used -= old
+                evicted.append(local)
+            for path in list(self._copies):
+                if self._used + size <= self.quota:
+                    break
+                if path not in self._copying:
+                    self._used -= self._copies.pop(path)
+                    evicted.append(path)
+            self._copies[local] = size
+            self._copying.add(local)
+            self._used += size
+            self._verified = {k: v for k, v in self._verified.items()
+                              if v not in evicted}
+        for path in evicted:
+            # readers that have the file open keep reading it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    @property
+    def used(self):
+        ''' The bytes taken by copies, including those being made.'''
+        return self._used
+
+    def close(self):
+        self._executor.shutdown()
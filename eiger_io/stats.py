@@ -0,0 +1,234 @@
+''' Per-pixel statistics of a run in one streaming pass.
+
+    ``PixelMoments`` accumulates the per-pixel mean and variance of blocks
+    of frames, merging the statistics of every block with those so far
+    (Chan et al.'s update of Welford's algorithm), so it is numerically
+    stable over long runs and only holds a few frames of float64. Partial
+    results merge, e.g. from threads or processes reading parts of a run.
+
+    ``pixel_moments`` feeds one from the block reader of ``EigerImages``::
+
+        moments = pixel_moments(images, block_size=100, n_workers=4)
+        mean, var = moments.mean, moments.variance()
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class PixelMoments(object):
+    ''' Streaming per-pixel mean and variance.
+
+        Parameters
+        ----------
+        frame_shape : tuple
+            the shape of the frames
+
+        mask : numpy.ndarray of bool, optional
+            True for the pixels to report, e.g. ``md['binary_mask']``. The
+            others are NaN in the results.
+
+        bin_size : int, optional
+            sum this many consecutive frames into one before accumulating,
+            a trailing partial bin is left out
+
+        frame_contrast : bool, optional
+            also record the speckle contrast of every (binned) frame over
+            the pixels of the mask
+
+        Attributes
+        ----------
+        count : int
+            the number of (binned) frames accumulated
+    '''
+    def __init__(self, frame_shape, mask=None, bin_size=1,
+                 frame_contrast=False):
+        self.frame_shape = tuple(frame_shape)
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.bin_size = bin_size
+        self.count = 0
+        self._mean = np.zeros(self.frame_shape)
+        self._m2 = np.zeros(self.frame_shape)
+        # frames of an incomplete bin
+        self._partial = None
+        self._n_partial = 0
+        self._contrast = [] if frame_contrast else None
+
+    def update(self, frames):
+        ''' Accumulate a block of frames, of shape (n,) + frame_shape.'''
+        frames = np.asarray(frames)
+        if self.bin_size > 1:
+            frames = self._bin(frames)
+        n = len(frames)
+        if not n:
+            return self
+        mean = np.add.reduce(frames, axis=0, dtype=np.float64)
+        mean /= n
+        m2 = np.zeros(self.frame_shape)
+        for frame in frames:
+            delta = frame - mean
+            delta *= delta
+            m2 += delta
+        if self._contrast is not None:
+            self._contrast.extend(self._frame_contrast(frame)
+                                  for frame in frames)
+        self._merge(n, mean, m2)
+        return self
+
+    def _bin(self, frames):
+        ''' The complete bins of frames, after those left from the last
+            update.'''
+        b = self.bin_size
+        if self._n_partial:
+            k = min(b - self._n_partial, len(frames))
+            self._partial += np.add.reduce(frames[:k], axis=0,
+                                           dtype=np.float64)
+            self._n_partial += k
+            frames = frames[k:]
+            if self._n_partial < b:
+                return frames[:0]
+            binned = [self._partial]
+            self._partial, self._n_partial = None, 0
+        else:
+            binned = []
+        n = len(frames) // b * b
+        if n:
+            binned.extend(np.add.reduce(
+                frames[:n].reshape((-1, b) + self.frame_shape), axis=1,
+                dtype=np.float64))
+        if n < len(frames):
+            self._partial = np.add.reduce(frames[n:], axis=0,
+                                          dtype=np.float64)
+            self._n_partial = len(frames) - n
+        if not binned:
+            return np.empty((0,) + self.frame_shape)
+        return np.stack(binned)
+
+    def _frame_contrast(self, frame):
+        pixels = frame if self.mask is None else frame[self.mask]
+        mean = pixels.mean(dtype=np.float64)
+        return np.sqrt(pixels.var(dtype=np.float64)) / mean
+
+    def _merge(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self._mean
+        self._mean += delta * (n / total)
+        delta *= delta
+        delta *= self.count * n / total
+        self._m2 += m2
+        self._m2 += delta
+        self.count = total
+
+    def merge(self, other):
+        ''' Add the frames accumulated by other, which come after those of
+            self (this only matters for incomplete bins and
+            ``frame_contrast``).'''
+        if other._n_partial:
+            raise ValueError("Cannot merge moments with an incomplete time "
+                             "bin, split the frames at multiples of "
+                             "bin_size")
+        if other.count:
+            self._merge(other.count, other._mean, other._m2)
+        if self._contrast is not None:
+            self._contrast.extend(other._contrast or [])
+        return self
+
+    def _masked(self, arr):
+        if self.mask is not None:
+            arr[~self.mask] = np.nan
+        return arr
+
+    @property
+    def mean(self):
+        ''' The per-pixel mean.'''
+        return self._masked(self._mean.copy())
+
+    def variance(self, ddof=0):
+        ''' The per-pixel variance, with ddof delta degrees of freedom.'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._masked(self._m2 / (self.count - ddof))
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    def contrast(self, ddof=0):
+        ''' The per-pixel speckle contrast std/mean, over time.'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.std(ddof) / self.mean
+
+    @property
+    def frame_contrast(self):
+        ''' The speckle contrast of every (binned) frame, std/mean over the
+            pixels of the mask, if recorded.'''
+        if self._contrast is None:
+            return None
+        return np.array(self._contrast)
+
+
+def _blocks(images, block_size, start, stop):
+    ''' Blocks of frames [start, stop), from the block reader if the images
+        have one.'''
+    if hasattr(images, 'iter_blocks'):
+        for _, block in images.iter_blocks(block_size, start, stop):
+            yield block
+        return
+    for first in range(start, stop, block_size):
+        yield np.stack([images.read_frame(i) for i in
+                        range(first, min(stop, first + block_size))])
+
+
+def pixel_moments(images, block_size=100, start=0, stop=None, mask=True,
+                  bin_size=1, frame_contrast=False, n_workers=1):
+    ''' Per-pixel moments of frames [start, stop) of a run.
+
+        Parameters
+        ----------
+        images : EigerImages or PIMSDask
+            the run
+
+        block_size : int, optional
+            the number of frames read at once
+
+        mask : bool or numpy.ndarray, optional
+            True to use ``images.md['binary_mask']``, or the mask to use
+
+        n_workers : int, optional
+            the number of threads reading parts of the run, whose moments
+            are then merged
+
+        See ``PixelMoments`` for the other parameters.
+
+        Returns
+        -------
+        moments : PixelMoments
+    '''
+    if stop is None:
+        stop = len(images)
+    if mask is True:
+        mask = (images.md or {}).get('binary_mask')
+    elif mask is False:
+        mask = None
+
+    def accumulate(bounds):
+        moments = PixelMoments(images.frame_shape, mask, bin_size,
+                               frame_contrast)
+        for block in _blocks(images, block_size, *bounds):
+            moments.update(block)
+        return moments
+
+    # split at multiples of bin_size, so that every part has whole bins
+    n_bins = (stop - start) // bin_size
+    edges = [start + bin_size * (n_bins * k // n_workers)
+             for k in range(n_workers)] + [stop]
+    parts = list(zip(edges[:-1], edges[1:]))
+    if n_workers == 1:
+        return accumulate(parts[0])
+    with ThreadPoolExecutor(n_workers) as executor:
+        results = list(executor.map(accumulate, parts))
+    moments = results[0]
+    for other in results[1:-1]:
+        moments.merge(other)
+    last = results[-1]
+    # the trailing partial bin is left out anyway
+    last._partial, last._n_partial = None, 0
+    return moments.merge(last)
@@ -0,0 +1,413 @@
+''' Receiver for the EIGER stream interface.
+
+    The detector control unit can push every series over ZeroMQ instead of
+    (or as well as) writing HDF5 files. A series is a global header
+    message, one multipart message per image and an end of series message::
+
+        dheader-1.0     [config] [flatfield] [pixel mask] [countrate table]
+        dimage-1.0      dimage_d-1.0 <data> dconfig-1.0
+        dseries_end-1.0
+
+    ``EigerStreamReceiver`` pulls those messages, decodes the images in a
+    pool of threads and hands out ``StreamImages``, which behave like
+    ``EigerImages`` (same ``md`` keys, ``follow`` iteration) while the series
+    is still arriving. ``EigerStreamPublisher`` is a stand-in for the detector
+    to use in tests.
+
+    pyzmq is only needed when a receiver or publisher is created.
+'''
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pims import FramesSequence, Frame
+
+from .codecs import bslz4_decode, bslz4_encode, lz4_decode, lz4_encode
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+# md key -> detector config key sent in the global header
+STREAM_MD_LAYOUT = {
+    'y_pixel_size': 'y_pixel_size',
+    'x_pixel_size': 'x_pixel_size',
+    'detector_distance': 'detector_distance',
+    'incident_wavelength': 'wavelength',
+    'frame_time': 'frame_time',
+    'beam_center_x': 'beam_center_x',
+    'beam_center_y': 'beam_center_y',
+    'count_time': 'count_time',
+}
+
+
+def decode_frame(buf, encoding, shape, dtype):
+    ''' Decode one image of the stream interface.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            the data part of the image message
+
+        encoding : str
+            the ``encoding`` of the ``dimage_d-1.0`` part, e.g. ``bs32-lz4<``
+
+        shape : tuple
+            the shape as sent by the detector, i.e. (x, y)
+
+        dtype : str
+            the ``type`` of the ``dimage_d-1.0`` part
+
+        Returns
+        -------
+        img : numpy.ndarray
+            the image, of shape (y, x)
+    '''
+    shape = tuple(shape)[::-1]
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if encoding.startswith('bs') and '-lz4' in encoding:
+        return bslz4_decode(buf, shape, dtype)
+    elif encoding.startswith('lz4'):
+        return lz4_decode(buf, shape, dtype)
+    elif encoding == '<':
+        return np.frombuffer(buf, dtype=dtype).reshape(shape).copy()
+    raise ValueError("Unsupported stream encoding {!r}".format(encoding))
+
+
+def _encode_frame(img, encoding):
+    if encoding.startswith('bs') and '-lz4' in encoding:
+        return bslz4_encode(img)
+    elif encoding.startswith('lz4'):
+        return lz4_encode(img)
+    elif encoding == '<':
+        return np.ascontiguousarray(img).astype(img.dtype.newbyteorder('<'),
+                                                copy=False).tobytes()
+    raise ValueError("Unsupported stream encoding {!r}".format(encoding))
+
+
+def _require_zmq():
+    if zmq is None:
+        raise ImportError("pyzmq is required to use the EIGER stream "
+                          "interface.")
+
+
+def _md_from_header(config, pixel_mask=None, flatfield=None):
+    md = {k: config[v] for k, v in STREAM_MD_LAYOUT.items() if v in config}
+    if pixel_mask is not None:
+        # same meaning as the pixel mask in the master file
+        md['pixel_mask'] = pixel_mask
+        md['binary_mask'] = (pixel_mask == 0)
+    if flatfield is not None:
+        md['flatfield'] = flatfield
+    if 'frame_time' in md:
+        md['framerate'] = 1./md['frame_time']
+    return md
+
+
+class StreamImages(FramesSequence):
+    ''' The images of one series, as they arrive from the stream.
+
+        The length is the number of images received so far. ``get_frame``
+        waits for an image that has been announced by the detector but not
+        received yet.
+    '''
+    def __init__(self, series, md=None, config=None):
+        self.series = series
+        self._md = md
+        self.config = config or {}
+        self._futures = []
+        self._frame_md = []
+        self._done = False
+        self._cond = threading.Condition()
+
+    @property
+    def md(self):
+        return self._md
+
+    @property
+    def expected_length(self):
+        '''The total number of frames announced in the header, if any.'''
+        try:
+            return (int(self.config['nimages']) *
+                    int(self.config.get('ntrigger', 1)))
+        except KeyError:
+            return None
+
+    @property
+    def complete(self):
+        '''True once the end of series message was received.'''
+        return self._done
+
+    def _append(self, future, frame_md):
+        with self._cond:
+            self._futures.append(future)
+            self._frame_md.append(frame_md)
+            self._cond.notify_all()
+
+    def _finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def wait(self, n, timeout=None):
+        ''' Block until at least n frames were received.
+
+            Returns
+            -------
+            ok : bool
+                False if the series ended or the timeout expired first
+        '''
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: len(self._futures) >= n or self._done,
+                timeout) and len(self._futures) >= n
+
+    def get_frame(self, i):
+        if not self.wait(i + 1):
+            raise IndexError("Frame {} is not part of series {}"
+                             .format(i, self.series))
+        img = self._futures[i].result()
+        return Frame(img, frame_no=i, metadata=self._frame_md[i])
+
+    def __len__(self):
+        return len(self._futures)
+
+    def refresh(self):
+        ''' Return the number of frames received so far.
+
+            Present for compatibility with ``EigerImages.refresh``, frames
+            are added in the background.
+        '''
+        return len(self)
+
+    def follow(self, start=0, poll_interval=None, timeout=None):
+        ''' Iterate over frames as they are received.
+
+            Iteration ends at the end of the series, or when no new frame
+            has arrived for ``timeout`` seconds. ``poll_interval`` is
+            accepted for compatibility with ``EigerImages.follow``.
+        '''
+        i = start
+        while self.wait(i + 1, timeout):
+            yield self.get_frame(i)
+            i += 1
+
+    @property
+    def frame_shape(self):
+        return self[0].shape
+
+    @property
+    def pixel_type(self):
+        return self[0].dtype
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    @property
+    def shape(self):
+        return self.frame_shape
+
+
+class EigerStreamReceiver(object):
+    ''' Receive series from the EIGER stream interface.
+
+        Parameters
+        ----------
+        endpoint : str
+            the ZeroMQ endpoint of the detector, e.g. ``tcp://dcu:9999``
+
+        n_workers : int, optional
+            the number of threads decoding images
+
+        context : zmq.Context, optional
+            the context to create the socket in
+    '''
+    # how often the background thread checks for close(), in ms
+    _POLL_MS = 100
+
+    def __init__(self, endpoint, n_workers=4, context=None):
+        _require_zmq()
+        self.endpoint = endpoint
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.PULL)
+        self._socket.connect(endpoint)
+        self._executor = ThreadPoolExecutor(n_workers)
+        self._closed = threading.Event()
+        self._thread = None
+        # set to stop the thread receiving the current series
+        self._stop = threading.Event()
+
+    def _recv(self, timeout, stop=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not (self._closed.is_set() or stop is not None and
+                   stop.is_set()):
+            if self._socket.poll(self._POLL_MS):
+                return self._socket.recv_multipart(copy=False)
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("No message from {} within {} s"
+                                   .format(self.endpoint, timeout))
+        return None
+
+    def receive_series(self, timeout=None):
+        ''' Wait for the next series and start receiving its images.
+
+            A previous series stops receiving: its ``StreamImages`` keeps
+            the images received so far and is complete, the images of it
+            still to come are dropped.
+
+            Parameters
+            ----------
+            timeout : float or None, optional
+                seconds to wait for the global header
+
+            Returns
+            -------
+            images : StreamImages
+                filled in the background until the end of series
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._stop = threading.Event()
+        while True:
+            parts = self._recv(timeout)
+            if parts is None:
+                raise RuntimeError("The receiver was closed.")
+            header = json.loads(parts[0].bytes)
+            if header.get('htype', '').startswith('dheader'):
+                break
+        config = {}
+        if header.get('header_detail', 'none') != 'none':
+            config = json.loads(parts[1].bytes)
+        arrays = {}
+        # optional (header, blob) pairs: flatfield, pixel mask, countrate
+        for j in range(2, len(parts) - 1, 2):
+            desc = json.loads(parts[j].bytes)
+            if 'shape' not in desc:
+                continue
+            arrays[desc['htype']] = np.frombuffer(
+                parts[j + 1].buffer, dtype=desc['type']).reshape(
+                    desc['shape'][::-1]).copy()
+        md = _md_from_header(config,
+                             pixel_mask=arrays.get('dpixelmask-1.0'),
+                             flatfield=arrays.get('dflatfield-1.0'))
+        images = StreamImages(header.get('series'), md=md, config=config)
+        self._thread = threading.Thread(target=self._receive_images,
+                                        args=(images, self._stop),
+                                        daemon=True)
+        self._thread.start()
+        return images
+
+    def _receive_images(self, images, stop):
+        try:
+            while True:
+                parts = self._recv(None, stop)
+                if parts is None:
+                    return
+                header = json.loads(parts[0].bytes)
+                htype = header.get('htype', '')
+                if htype.startswith('dseries_end'):
+                    return
+                if not htype.startswith('dimage'):
+                    continue
+                desc = json.loads(parts[1].bytes)
+                frame_md = {}
+                if len(parts) > 3:
+                    frame_md = json.loads(parts[3].bytes)
+                future = self._executor.submit(
+                    decode_frame, parts[2].buffer, desc['encoding'],
+                    desc['shape'], desc['type'])
+                images._append(future, frame_md)
+        finally:
+            images._finish()
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+        self._socket.close()
+
+
+class EigerStreamPublisher(object):
+    ''' A stand-in for the stream interface of the detector.
+
+        Parameters
+        ----------
+        endpoint : str
+            the ZeroMQ endpoint to bind, e.g. ``tcp://*:9999``
+
+        context : zmq.Context, optional
+            the context to create the socket in
+    '''
+    def __init__(self, endpoint, context=None):
+        _require_zmq()
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.bind(endpoint)
+
+    def send_series(self, frames, series=1, config=None, pixel_mask=None,
+                    flatfield=None, encoding='bs32-lz4<', frame_time=None):
+        ''' Send a series of frames the way the detector does.
+
+            Parameters
+            ----------
+            frames : iterable of numpy.ndarray
+                the images
+
+            series : int, optional
+                the series id
+
+            config : dict, optional
+                the detector configuration sent with the global header
+
+            pixel_mask, flatfield : numpy.ndarray, optional
+                sent with the global header if given
+
+            encoding : str, optional
+                one of ``bs32-lz4<``, ``bs16-lz4<``, ``bs8-lz4<``, ``lz4<``
+                or ``<`` (uncompressed)
+
+            frame_time : float, optional
+                seconds to wait between images
+        '''
+        send = self._socket.send_multipart
+        extra = []
+        for htype, arr in (('dflatfield-1.0', flatfield),
+                           ('dpixelmask-1.0', pixel_mask)):
+            if arr is not None:
+                arr = np.ascontiguousarray(arr)
+                extra += [_json({'htype': htype, 'type': arr.dtype.name,
+                                 'shape': arr.shape[::-1]}),
+                          arr.tobytes()]
+        detail = 'all' if extra else 'basic'
+        send([_json({'htype': 'dheader-1.0', 'series': series,
+                     'header_detail': detail}),
+              _json(config or {})] + extra)
+        for i, img in enumerate(frames):
+            img = np.asarray(img)
+            start = time.time()
+            blob = _encode_frame(img, encoding)
+            send([_json({'htype': 'dimage-1.0', 'series': series,
+                         'frame': i, 'hash': ''}),
+                  _json({'htype': 'dimage_d-1.0',
+                         'shape': img.shape[::-1], 'type': img.dtype.name,
+                         'encoding': encoding, 'size': len(blob)}),
+                  blob,
+                  _json({'htype': 'dconfig-1.0', 'start_time': start,
+                         'stop_time': time.time(), 'real_time': 0})])
+            if frame_time:
+                time.sleep(frame_time)
+        send([_json({'htype': 'dseries_end-1.0', 'series': series})])
+
+    def close(self):
+        self._socket.close()
+
+
+def _json(obj):
+    return json.dumps(obj).encode()
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from eiger_io.aio import AsyncEigerHandler, AsyncEigerImages
+
+from .utils import make_run
+
+
+def test_async_images(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+
+    async def main():
+        async with await AsyncEigerImages.open(master_path, 4) as images:
+            assert await images.alen() == 10
+            assert np.array_equal(await images.aget_frame(3), data[3])
+            frames = [f async for f in images.aiter_frames(1, 9, step=3)]
+            assert np.array_equal(np.stack(frames), data[1:9:3])
+            frames = await asyncio.gather(*(images.aget_frame(i)
+                                            for i in range(10)))
+            assert np.array_equal(np.stack(frames), data)
+            # leaving early cancels the frames read ahead
+            async for frame in images.aiter_frames(prefetch=4):
+                break
+            assert np.array_equal(frame, data[0])
+    asyncio.run(main())
+
+
+def test_max_concurrency(tmp_path):
+    master_path, _ = make_run(str(tmp_path))
+    lock = threading.Lock()
+    running = [0, 0]
+
+    async def main():
+        images = await AsyncEigerImages.open(master_path, 4,
+                                             max_concurrency=2)
+        get_frame = images.images.get_frame
+
+        def slow_get_frame(i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(.02)
+            with lock:
+                running[0] -= 1
+            return get_frame(i)
+        images.images.get_frame = slow_get_frame
+        await asyncio.gather(*(images.aget_frame(i) for i in range(10)))
+        await images.aclose()
+    asyncio.run(main())
+    assert running[1] == 2
+
+
+def test_async_handler(tmp_path):
+    _, data = make_run(str(tmp_path))
+    handler = AsyncEigerHandler(str(tmp_path / 'scan'), images_per_file=4)
+
+    async def main():
+        md = await handler.aload_metadata(1)
+        assert md['threshold_energy'] == 4000.
+        assert np.array_equal(await handler(1, frame_num=5), data[5])
+        images = await handler(1)
+        assert images.md['binary_mask'].sum() == 16 * 20 - 1
+        assert np.array_equal(await images.aget_frame(9), data[9])
+        await images.aclose()
+    asyncio.run(main())
+    handler.close()
@@ -0,0 +1,42 @@
+import numpy as np
+
+from eiger_io.direct import ChunkCache
+from eiger_io.fs_handler import EigerImages
+
+from .utils import make_run
+
+
+def test_chunk_cache(tmp_path):
+    # one chunk per frame
+    master_path, data = make_run(str(tmp_path), nimages=10)
+    cache = ChunkCache(1 << 20)
+    images = EigerImages(master_path, 4, chunk_cache=cache)
+    assert images.direct
+    assert np.array_equal(images.get_frames(slice(None)), data)
+    assert (cache.hits, cache.misses, len(cache)) == (0, 10, 10)
+    assert np.array_equal(images.get_frames(slice(None)), data)
+    assert (cache.hits, cache.misses) == (10, 10)
+    # shared by readers of the same run
+    other = EigerImages(master_path, 4, chunk_cache=cache)
+    assert np.array_equal(other.get_frames([8, 2, 2]), data[[8, 2, 2]])
+    # a frame asked for twice is read once
+    assert (cache.hits, cache.misses) == (12, 10)
+
+
+def test_chunk_cache_eviction(tmp_path):
+    master_path, data = make_run(str(tmp_path), nimages=10)
+    images = EigerImages(master_path, 4, chunk_cache=1 << 20)
+    images.get_frames(slice(None))
+    cache = images.chunk_cache
+    # room for 3 chunks: reading in order again always misses
+    cache.nbytes = sum(sorted(len(buf) for buf in
+                              cache._chunks.values())[-3:])
+    cache.clear()
+    images.get_frames(slice(None))
+    assert len(cache) == 3 and cache.size <= cache.nbytes
+    hits = cache.hits
+    assert np.array_equal(images.get_frames(slice(None)), data)
+    assert cache.hits == hits
+    # the last frames read are still cached
+    images.get_frames([9])
+    assert cache.hits == hits + 1
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from eiger_io.fs_handler import EigerImages
+from eiger_io.fs_handler_dask import PIMSDask, _load_eiger_images
+
+from .utils import make_run
+
+
+def _expected(data):
+    gain = np.full(data.shape[1:], 1.5, dtype=np.float32)
+    gain[0, 0] = 0
+    return (data * gain).astype(np.float32)
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_flatfield(tmp_path, direct):
+    master_path, data = make_run(str(tmp_path))
+    expected = _expected(data)
+    images = EigerImages(master_path, 4, direct=direct, flatfield=True)
+    assert images.direct == direct
+    assert images.dtype == np.float32
+    assert np.array_equal(images.get_frames(slice(None)), expected)
+    assert np.array_equal(images[3], expected[3])
+    assert np.array_equal(images.get_frames([7, 1]), expected[[7, 1]])
+    roi = (slice(0, 5), slice(0, 4))
+    assert np.array_equal(images.read_roi(roi, 2, 6),
+                          expected[(slice(2, 6),) + roi])
+
+
+def test_flatfield_dask(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    frames, md = _load_eiger_images(master_path)
+    images = PIMSDask(frames, md=md, flatfield=True)
+    assert images.dtype == np.float32
+    assert np.array_equal(images.compute(), _expected(data))
+    assert np.array_equal(images[3], _expected(data)[3])
+
+
+def test_flatfield_missing(tmp_path):
+    master_path, _ = make_run(str(tmp_path))
+    frames, _ = _load_eiger_images(master_path)
+    with pytest.raises(ValueError):
+        PIMSDask(frames, md={}, flatfield=True)
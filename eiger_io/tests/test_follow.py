@@ -0,0 +1,46 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from eiger_io.fs_handler import EigerImages
+
+from .utils import make_run
+
+
+@pytest.mark.parametrize('swmr', [False, True])
+def test_follow(tmp_path, swmr):
+    master_path, data = make_run(str(tmp_path), nimages=10,
+                                 images_per_file=4)
+    # data files 2 and 3 are written later
+    (tmp_path / 'later').mkdir()
+    names = ['scan_1_data_00000{}.h5'.format(i) for i in (2, 3)]
+    for name in names:
+        os.rename(str(tmp_path / name), str(tmp_path / 'later' / name))
+    images = EigerImages(master_path, 4, swmr=swmr)
+    assert images.refresh() == 4
+    assert images.expected_length == 10
+
+    def write():
+        for name in names:
+            time.sleep(.2)
+            os.rename(str(tmp_path / 'later' / name), str(tmp_path / name))
+    writer = threading.Thread(target=write)
+    writer.start()
+    frames = list(images.follow(poll_interval=.05, timeout=5))
+    writer.join()
+    assert np.array_equal(np.stack(frames), data)
+    assert len(images) == 10
+
+
+def test_follow_timeout(tmp_path):
+    master_path, data = make_run(str(tmp_path), nimages=10,
+                                 images_per_file=4)
+    os.remove(str(tmp_path / 'scan_1_data_000003.h5'))
+    images = EigerImages(master_path, 4)
+    start = time.monotonic()
+    frames = list(images.follow(start=2, poll_interval=.05, timeout=.2))
+    assert time.monotonic() - start < 2
+    assert np.array_equal(np.stack(frames), data[2:8])
@@ -0,0 +1,181 @@
+import gc
+import os
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from eiger_io.fs_handler import (EigerHandler, EigerImages,
+                                 MemoryBudgetExceeded)
+from eiger_io.fs_handler_dask import (EigerHandlerDask, PIMSDask,
+                                      _load_eiger_images)
+
+from .utils import make_run
+
+
+def test_slice_memory_budget(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    images = EigerImages(master_path, 4, memory_budget=100)
+    with pytest.raises(MemoryBudgetExceeded):
+        np.asarray(images[:])
+    # single frames fit
+    assert np.array_equal(images[3], data[3])
+
+    images = EigerImages(master_path, 4, memory_budget=data[0].nbytes * 3,
+                         on_exceed='stream')
+    blocks = list(images[2:9])
+    assert [len(b) for b in blocks] == [3, 3, 1]
+    assert np.array_equal(np.concatenate(blocks), data[2:9])
+
+
+def test_dask_slice_memory_budget(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    frames, md = _load_eiger_images(master_path)
+    images = PIMSDask(frames, md=md, memory_budget=100)
+    with pytest.raises(MemoryBudgetExceeded):
+        np.asarray(images[:])
+    # the dask array is not checked, see PIMSDask._to_dask
+    assert np.array_equal(images._to_dask().compute(), data)
+
+
+def test_frames_without_first_data_file(tmp_path):
+    # reading a frame only opens the data file it is in
+    master_path, data = make_run(str(tmp_path), nimages=25, images_per_file=4)
+    os.remove(str(tmp_path / 'scan_1_data_000001.h5'))
+    handler = EigerHandlerDask(str(tmp_path / 'scan'), images_per_file=4)
+    assert np.array_equal(handler(1, frame_num=24), data[24])
+    handler = EigerHandlerDask(str(tmp_path / 'scan'), images_per_file=4)
+    assert np.array_equal(handler.bulk_call([{'seq_id': 1, 'frame_num': 9},
+                                             {'seq_id': 1, 'frame_num': 5}]),
+                          data[[9, 5]])
+    handler = EigerHandler(str(tmp_path / 'scan'), images_per_file=4)
+    assert np.array_equal(handler(1, frame_num=24), data[24])
+    assert np.array_equal(handler.bulk_call([{'seq_id': 1, 'frame_num': 9},
+                                             {'seq_id': 1, 'frame_num': 5}]),
+                          data[[9, 5]])
+    images = EigerImages(master_path, 4)
+    assert np.array_equal(next(iter(images.iter_frames(start=8))), data[8])
+    images = EigerImages(master_path, 4)
+    first, block = next(iter(images.iter_blocks(3, start=4)))
+    assert np.array_equal(block, data[4:7])
+    images = EigerImages(master_path, 4)
+    assert np.array_equal(images.get_frames(slice(20, 25)), data[20:])
+
+
+@pytest.mark.parametrize('start, stop', [(0, 9), (5, 3), (-1, 2), (8, 8)])
+def test_out_of_range(tmp_path, start, stop):
+    master_path, _ = make_run(str(tmp_path), nimages=7)
+    images = EigerImages(master_path, 4)
+    with pytest.raises(IndexError):
+        images.read_roi((slice(None),) * 2, start, stop)
+    with pytest.raises(IndexError):
+        list(images.iter_blocks(2, start, stop))
+
+
+def test_thread_handles_closed(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    images = EigerImages(master_path, 4)
+    fds = len(os.listdir('/proc/self/fd')) if os.path.isdir(
+        '/proc/self/fd') else None
+    for i in range(50):
+        thread = threading.Thread(target=images.read_frame, args=(i % 10,))
+        thread.start()
+        thread.join()
+    gc.collect()
+    # the handle of the main thread
+    assert len(images._handles) == 1
+    if fds is not None:
+        assert len(os.listdir('/proc/self/fd')) <= fds + 2
+    assert np.array_equal(images.read_frame(3), data[3])
+    images.close()
+
+
+def test_aborted_run(tmp_path):
+    # the detector was set up for 11 frames, only 10 were written
+    master_path, data = make_run(str(tmp_path), nimages=10, images_per_file=4)
+    with h5py.File(master_path, 'r+') as f:
+        f['entry/instrument/detector/detectorSpecific/nimages'][()] = 11
+    images = EigerImages(master_path, 4)
+    assert len(images) == 10
+    assert images.expected_length == 11
+    assert np.array_equal(images.get_frames(slice(None)), data)
+    frames, _ = _load_eiger_images(master_path)
+    assert np.array_equal(frames.compute(), data)
+
+
+@pytest.mark.parametrize('kwargs', [{'direct': True}, {'index': True},
+                                    {'chunk_cache': 1 << 20}])
+def test_data_in_master(tmp_path, kwargs):
+    # no external links to index, read through h5py
+    master_path, data = make_run(str(tmp_path), in_master=True)
+    images = EigerImages(master_path, 4, **kwargs)
+    assert images.index is None and not images.direct
+    assert np.array_equal(images.get_frames(slice(None)), data)
+
+
+def test_shared_read_not_shared_memory(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    images = EigerImages(master_path, 4, raw=True)
+    release = threading.Event()
+    read_frame = images.read_frame
+
+    def slow_read_frame(i, out=None):
+        release.wait(5)
+        return read_frame(i, out)
+    images.read_frame = slow_read_frame
+    frames = {}
+
+    def get_frame(name):
+        frames[name] = images.get_frame(2)
+    owner = threading.Thread(target=get_frame, args=('owner',))
+    owner.start()
+    while 2 not in images._inflight:
+        time.sleep(.001)
+    future, _ = images._inflight[2]
+    waiter = threading.Thread(target=get_frame, args=('waiter',))
+    waiter.start()
+    while images._inflight[2][1] == 0:
+        time.sleep(.001)
+    release.set()
+    owner.join()
+    waiter.join()
+    # the owner may change its frame, the one the waiter copies is kept
+    assert not np.shares_memory(frames['owner'], future.result())
+    assert np.array_equal(frames['owner'], data[2])
+    assert np.array_equal(frames['waiter'], data[2])
+
+
+def test_access_pattern_per_thread(tmp_path):
+    master_path, data = make_run(str(tmp_path), chunks=(2, 8, 10))
+    images = EigerImages(master_path, 4, rdcc_nbytes='auto')
+    images.read_frame(0)
+    dataset = images._local.datasets['data_000001']
+    cache = images._chunk_cache((4, 16, 20), (2, 8, 10), 4)
+    roi = (slice(2, 6), slice(3, 9))
+    thread = threading.Thread(target=images.read_roi, args=(roi, 0, 4))
+    thread.start()
+    thread.join()
+    # this thread still reads whole frames, with the datasets opened for
+    # them
+    assert images._chunk_cache((4, 16, 20), (2, 8, 10), 4) == cache
+    assert np.array_equal(images.read_frame(1), data[1])
+    assert images._local.datasets['data_000001'] is dataset
+    assert np.array_equal(images.read_roi(roi, 0, 4), data[(slice(0, 4),) +
+                                                            roi])
+
+
+@pytest.mark.parametrize('direct', [False, True])
+@pytest.mark.parametrize('key', [slice(None), slice(2, 9, 3),
+                                 slice(None, None, -1), slice(8, 1, -3),
+                                 slice(5, 5),
+                                 [7, 1, 7, 3, 4, 0], [-1, 2, -1],
+                                 np.arange(10) % 3 == 0])
+def test_get_frames(tmp_path, direct, key):
+    master_path, data = make_run(str(tmp_path), nimages=10)
+    images = EigerImages(master_path, 4, direct=direct)
+    assert np.array_equal(images.get_frames(key), data[key])
+    out = np.zeros_like(data[key])
+    assert images.get_frames(key, out=out) is out
+    assert np.array_equal(out, data[key])
@@ -0,0 +1,26 @@
+import numpy as np
+
+from eiger_io.fs_handler_dask import EigerHandlerDask
+from eiger_io.index import RunIndex
+
+from .utils import make_run
+
+
+def test_bad_index(tmp_path, monkeypatch):
+    master_path, data = make_run(str(tmp_path))
+    path = RunIndex.open(master_path).save()
+    with open(path, 'r+b') as f:
+        f.truncate(100)
+    handler = EigerHandlerDask(str(tmp_path / 'scan'), 4)
+    assert np.array_equal(handler(1).compute(), data)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError
+    monkeypatch.setattr(RunIndex, 'load', broken)
+    assert np.array_equal(handler(1).compute(), data)
+
+
+def test_data_in_master(tmp_path):
+    _, data = make_run(str(tmp_path), in_master=True)
+    handler = EigerHandlerDask(str(tmp_path / 'scan'), 4)
+    assert np.array_equal(handler(1).compute(), data)
@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import eiger_io
+
+
+@pytest.mark.parametrize('module', ['eiger_io.fs_handler',
+                                    'eiger_io.fs_handler_dask'])
+def test_import_is_light(module):
+    # loading a handler registry must not pay for these
+    code = ('import sys, {}; print(" ".join(m for m in '
+            '("h5py", "dask", "databroker") if m in sys.modules))'
+            .format(module))
+    root = os.path.dirname(os.path.dirname(eiger_io.__file__))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert out.decode().split() == []
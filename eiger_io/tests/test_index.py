@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from eiger_io import fs_handler
+from eiger_io.fs_handler import EigerImages
+from eiger_io.index import RunIndex, index_path
+
+from .utils import make_run
+
+
+def test_truncated_index(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    path = RunIndex.open(master_path).save()
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+    assert RunIndex.load(master_path) is None
+    # rebuilt
+    images = EigerImages(master_path, 4, direct=True)
+    assert images.direct
+    assert np.array_equal(images.get_frames(slice(None)), data)
+    assert RunIndex.load(master_path) is not None
+
+
+def test_concurrent_save(tmp_path):
+    master_path, _ = make_run(str(tmp_path))
+    index = RunIndex.build(master_path)
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: index.save(), range(32)))
+    assert RunIndex.load(master_path) is not None
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        ['scan_1_master.h5', os.path.basename(index_path(master_path))] +
+        ['scan_1_data_00000{}.h5'.format(i) for i in (1, 2, 3)])
+
+
+def test_index_with_swmr(tmp_path):
+    master_path, data = make_run(str(tmp_path))
+    images = EigerImages(master_path, 4, swmr=True, index=True)
+    assert images.index is None
+    assert len(images) == 10
+    assert np.array_equal(images.get_frames(slice(None)), data)
+
+
+def test_expected_length(tmp_path, monkeypatch):
+    master_path, _ = make_run(str(tmp_path), nimages=11)
+    RunIndex.open(master_path)
+    index = RunIndex.load(master_path)
+    assert index.expected_length == 11
+
+    def unused(f):
+        raise AssertionError("read from the master file")
+    monkeypatch.setattr(fs_handler, '_expected_length', unused)
+    assert EigerImages(master_path, 4, index=True).expected_length == 11
@@ -0,0 +1,37 @@
+from eiger_io.fs_handler import EigerHandler
+from eiger_io.fs_handler_dask import EigerHandlerDask
+from eiger_io.metadata import load_metadata
+
+from .utils import make_run
+
+
+def test_load_metadata(tmp_path):
+    master_path, _ = make_run(str(tmp_path))
+    md = load_metadata(master_path, EigerHandler.EIGER_MD_LAYOUT)
+    # harvested beyond the layout
+    assert md['threshold_energy'] == 4000.
+    assert md['nimages'] == 10 and md['ntrigger'] == 1
+    assert md['framerate'] == 100.
+    assert md.paths['flatfield'] == ('entry/instrument/detector/'
+                                     'detectorSpecific/flatfield')
+    # large arrays are read on access
+    assert 'pixel_mask' in md and not md.is_loaded('pixel_mask')
+    assert md['pixel_mask'][0, 0] == 1
+    assert md.is_loaded('pixel_mask')
+    assert md['binary_mask'].sum() == 16 * 20 - 1
+    # and not again by later loads
+    assert load_metadata(master_path,
+                         EigerHandler.EIGER_MD_LAYOUT).is_loaded('pixel_mask')
+
+
+def test_arrays_not_shared(tmp_path):
+    make_run(str(tmp_path))
+    md = EigerHandler(str(tmp_path / 'scan'), 4)(1).md
+    md['pixel_mask'][...] = 7
+    md['flatfield'] *= 2
+    assert md.copy()['pixel_mask'].max() == 7
+    for handler in (EigerHandler, EigerHandlerDask):
+        md = handler(str(tmp_path / 'scan'), 4)(1).md
+        assert md['pixel_mask'].max() == 1
+        assert md['binary_mask'].sum() == 16 * 20 - 1
+        assert (md['flatfield'] == 1.5).all()
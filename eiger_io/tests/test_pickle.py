@@ -0,0 +1,44 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from eiger_io.fs_handler import EigerHandler, EigerImages
+from eiger_io.fs_handler_dask import EigerHandlerDask
+
+from .utils import make_run
+
+
+def _roundtrip(obj):
+    return pickle.loads(pickle.dumps(obj))
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'direct': True},
+                                    {'flatfield': True, 'raw': True}])
+def test_pickle_images(tmp_path, kwargs):
+    master_path, data = make_run(str(tmp_path))
+    images = EigerImages(master_path, 4, **kwargs)
+    expected = images.get_frames(slice(None))
+    copy = _roundtrip(images)
+    assert copy.direct == images.direct and copy.raw == images.raw
+    assert len(copy) == 10
+    assert np.array_equal(copy.get_frames(slice(None)), expected)
+    assert np.array_equal(copy[3], expected[3])
+    images.close()
+    # independent of the original
+    assert np.array_equal(copy.read_frame(5), expected[5])
+
+
+@pytest.mark.parametrize('handler_class', [EigerHandler, EigerHandlerDask])
+def test_pickle_handlers(tmp_path, handler_class):
+    master_path, data = make_run(str(tmp_path))
+    handler = handler_class(str(tmp_path / 'scan'), 4)
+    # with open readers
+    handler(1, frame_num=2)
+    copy = _roundtrip(handler)
+    assert np.array_equal(copy(1, frame_num=7), data[7])
+    images = _roundtrip(copy(1))
+    assert np.array_equal(np.asarray(images[:]), data)
+    assert images.md['binary_mask'].sum() == 16 * 20 - 1
+    handler.close()
+    copy.close()
@@ -0,0 +1,31 @@
+import os
+
+from eiger_io.index import index_path
+from eiger_io.probe import main, probe
+
+from .utils import make_run
+
+
+def test_probe(tmp_path):
+    master_path, _ = make_run(str(tmp_path))
+    results = probe(master_path, n_frames=5, threads=(2,))
+    assert results['decode_MBps'] is not None
+    for name in ('h5py', 'direct', 'dask'):
+        res = results['backends'][name]
+        assert set(res) == {'open_s', 'sequential', 'random', 'threads'}
+        assert list(res['threads']) == [2]
+
+
+def test_probe_data_in_master(tmp_path, capsys):
+    master_path, _ = make_run(str(tmp_path), in_master=True)
+    main([master_path, '--backend', 'h5py', '-n', '5', '--threads', '2'])
+    out = capsys.readouterr().out
+    assert 'decode' not in out
+    assert 'h5py: open' in out
+    # nothing indexed without the direct backend
+    assert not os.path.exists(index_path(master_path))
+    results = probe(master_path, n_frames=5, threads=(2,))
+    assert 'external link' in results['decode_MBps']
+    assert 'external link' in results['backends']['direct']
+    assert 'sequential' in results['backends']['h5py']
+    assert 'sequential' in results['backends']['dask']
@@ -0,0 +1,17 @@
+import numpy as np
+
+from eiger_io.procpool import ProcessPoolReader
+
+from .utils import make_run
+
+
+def test_read(tmp_path):
+    master_path, data = make_run(str(tmp_path), nimages=10)
+    with ProcessPoolReader(master_path, 4, n_workers=2,
+                           block_size=3) as reader:
+        assert np.array_equal(reader.read(1, 9), data[1:9])
+        with reader.read_shared(2, 10) as frames:
+            assert np.array_equal(frames.array, data[2:10])
+        assert frames.array is None
+        sums = reader.map_blocks(np.sum, block_size=3)
+        assert sum(sums) == data.sum()
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+from eiger_io.references import write_references
+
+from .utils import make_run
+
+
+def test_misaligned_chunks(tmp_path):
+    # the second data file starts within a chunk of 4 frames
+    master_path, _ = make_run(str(tmp_path), nimages=12, images_per_file=6,
+                              chunks=(4, 16, 20))
+    with pytest.raises(ValueError):
+        write_references(master_path)
+    assert not os.path.exists(master_path + '.refs.json')
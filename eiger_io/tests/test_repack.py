@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from eiger_io.repack import RepackedImages, repack
+
+from .utils import make_run
+
+
+@pytest.mark.parametrize('fmt', ['hdf5', 'zarr'])
+@pytest.mark.parametrize('max_memory', [1, 7 * 8 * 20 * 4, 1 << 30])
+def test_repack_bands(tmp_path, max_memory, fmt):
+    if fmt == 'zarr':
+        pytest.importorskip('zarr')
+    runs = [make_run(str(tmp_path), seq_id=k, nimages=n, images_per_file=4)
+            for k, n in ((1, 10), (2, 7))]
+    dest = str(tmp_path / 'repacked')
+    # tiles of 3 rows, read in bands of 3 or 6 rows, or whole frames
+    repack([m for m, _ in runs], dest, chunks=(7, 3, 8),
+           fmt=fmt, max_memory=max_memory)
+    images = RepackedImages(dest)
+    assert np.array_equal(images._to_dask().compute(),
+                          np.concatenate([d for _, d in runs]))
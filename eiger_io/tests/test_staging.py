@@ -0,0 +1,38 @@
+import os
+
+from eiger_io.staging import StagingCache
+
+
+def _files(dirname):
+    return sorted(os.path.join(dirpath, name)
+                  for dirpath, _, names in os.walk(dirname) for name in names)
+
+
+def test_scan_evicts_to_quota(tmp_path):
+    originals = []
+    for i in range(4):
+        path = str(tmp_path / 'file{}.h5'.format(i))
+        with open(path, 'wb') as f:
+            f.write(bytes(1000))
+        originals.append(path)
+    scratch = str(tmp_path / 'scratch')
+    cache = StagingCache(scratch, quota=10000)
+    copies = [future.result() for future in cache.stage(originals)]
+    cache.close()
+    assert cache.used == 4000
+    # last used in the order 1, 2, 3, 0
+    for i, j in enumerate([1, 2, 3, 0]):
+        mtime = os.stat(copies[j]).st_mtime_ns
+        os.utime(copies[j], ns=(mtime + i * 10**9, mtime))
+
+    cache = StagingCache(scratch, quota=2500)
+    assert cache.used == 2000
+    assert len(_files(scratch)) == 2
+    assert cache.local_path(originals[0]) is not None
+    assert cache.local_path(originals[3]) is not None
+    cache.close()
+
+    cache = StagingCache(scratch, quota=1)
+    assert cache.used == 0
+    assert _files(scratch) == []
+    cache.close()
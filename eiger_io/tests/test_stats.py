@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from eiger_io.fs_handler import EigerImages
+from eiger_io.metadata import load_metadata
+from eiger_io.stats import PixelMoments, pixel_moments
+
+from .utils import make_run
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+@pytest.mark.parametrize('bin_size', [1, 3])
+def test_pixel_moments(tmp_path, n_workers, bin_size):
+    master_path, data = make_run(str(tmp_path), nimages=20)
+    images = EigerImages(master_path, 4, md=load_metadata(master_path))
+    moments = pixel_moments(images, block_size=4, bin_size=bin_size,
+                            frame_contrast=True, n_workers=n_workers)
+    n = len(data) // bin_size * bin_size
+    binned = data[:n].reshape((-1, bin_size) + data.shape[1:]).sum(
+        axis=1, dtype=np.float64)
+    mask = np.ones(data.shape[1:], dtype=bool)
+    mask[0, 0] = False
+    assert moments.count == len(binned)
+    assert np.isnan(moments.mean[0, 0])
+    assert np.allclose(moments.mean[mask], binned.mean(axis=0)[mask])
+    assert np.allclose(moments.variance()[mask], binned.var(axis=0)[mask])
+    assert np.allclose(moments.variance(ddof=1)[mask],
+                       binned.var(axis=0, ddof=1)[mask])
+    assert np.allclose(moments.contrast()[mask],
+                       (binned.std(axis=0) / binned.mean(axis=0))[mask])
+    pixels = binned[:, mask]
+    assert np.allclose(moments.frame_contrast,
+                       pixels.std(axis=1) / pixels.mean(axis=1))
+
+
+def test_merge(tmp_path):
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 100, size=(12, 4, 5))
+    moments = PixelMoments((4, 5), bin_size=2)
+    # updates that split bins
+    for block in (frames[:3], frames[3:8], frames[8:]):
+        moments.update(block)
+    binned = frames.reshape(6, 2, 4, 5).sum(axis=1)
+    assert np.allclose(moments.variance(), binned.var(axis=0))
+
+    first, second = PixelMoments((4, 5)), PixelMoments((4, 5))
+    first.update(frames[:5])
+    second.update(frames[5:])
+    merged = first.merge(second)
+    assert merged.count == 12
+    assert np.allclose(merged.mean, frames.mean(axis=0))
+    assert np.allclose(merged.variance(), frames.var(axis=0))
+
+    partial = PixelMoments((4, 5), bin_size=2).update(frames[:3])
+    with pytest.raises(ValueError):
+        PixelMoments((4, 5), bin_size=2).merge(partial)
@@ -0,0 +1,63 @@
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('zmq')
+
+from eiger_io.stream import EigerStreamPublisher, EigerStreamReceiver  # noqa
+
+
+@pytest.fixture
+def stream(request):
+    endpoint = 'inproc://' + request.node.name
+    publisher = EigerStreamPublisher(endpoint)
+    receiver = EigerStreamReceiver(endpoint)
+    yield publisher, receiver
+    receiver.close()
+    publisher.close()
+
+
+def _send(publisher, *series):
+    thread = threading.Thread(
+        target=lambda: [publisher.send_series(frames, **kwargs)
+                        for frames, kwargs in series])
+    thread.start()
+    return thread
+
+
+def test_receive_series(stream):
+    publisher, receiver = stream
+    frames = np.arange(5 * 8 * 6, dtype='uint32').reshape(5, 8, 6)
+    pixel_mask = np.zeros((8, 6), dtype='uint32')
+    pixel_mask[1, 2] = 2
+    config = {'nimages': 5, 'ntrigger': 1, 'frame_time': 0.01}
+    thread = _send(publisher, (frames, dict(config=config,
+                                            pixel_mask=pixel_mask,
+                                            encoding='<')))
+    images = receiver.receive_series(timeout=5)
+    received = np.stack(list(images.follow(timeout=5)))
+    thread.join()
+    assert images.complete
+    assert images.expected_length == 5
+    assert np.array_equal(received, frames)
+    assert np.array_equal(images.md['pixel_mask'], pixel_mask)
+    assert images.md['binary_mask'].sum() == 8 * 6 - 1
+
+
+def test_next_series_drops_previous(stream):
+    publisher, receiver = stream
+    first = np.zeros((40, 8, 6), dtype='uint32')
+    second = np.ones((3, 8, 6), dtype='uint32')
+    thread = _send(publisher,
+                   (first, dict(series=1, encoding='<', frame_time=0.01)),
+                   (second, dict(series=2, encoding='<')))
+    previous = receiver.receive_series(timeout=5)
+    previous.wait(1, timeout=5)
+    images = receiver.receive_series(timeout=5)
+    assert previous.complete
+    assert 1 <= len(previous) < 40
+    assert images.md is not None
+    received = np.stack(list(images.follow(timeout=5)))
+    thread.join()
+    assert np.array_equal(received, second)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from eiger_io.repack import RepackedImages
+from eiger_io.vds import write_scan_vds, write_vds
+
+from .utils import make_run
+
+
+@pytest.mark.parametrize('layout', ['frames', 'points'])
+def test_write_vds(tmp_path, monkeypatch, layout):
+    runs = [make_run(str(tmp_path), seq_id=seq_id, nimages=10)
+            for seq_id in (1, 2)]
+    data = np.concatenate([d for _, d in runs])
+    (tmp_path / 'vds').mkdir()
+    dest = write_scan_vds(str(tmp_path / 'scan'), [1, 2],
+                          str(tmp_path / 'vds' / 'scan.h5'), layout=layout)
+    # sources are found relative to the virtual dataset file
+    (tmp_path / 'elsewhere').mkdir()
+    monkeypatch.chdir(str(tmp_path / 'elsewhere'))
+    images = RepackedImages(dest)
+    assert len(images) == 20
+    assert images.run_offsets == [0, 10]
+    assert images.md['binary_mask'].sum() == 16 * 20 - 1
+    assert np.array_equal(images._to_dask().compute(), data)
+    assert np.array_equal(images[13], data[13])
+    assert np.array_equal(images.pixel_series(3, 4), data[:, 3, 4])
+
+
+def test_write_vds_points_needs_same_length(tmp_path):
+    paths = [make_run(str(tmp_path), seq_id=1, nimages=10)[0],
+             make_run(str(tmp_path), seq_id=2, nimages=8)[0]]
+    with pytest.raises(ValueError):
+        write_vds(paths, str(tmp_path / 'scan.h5'), layout='points')
+    images = RepackedImages(write_vds(paths, str(tmp_path / 'scan.h5')))
+    assert len(images) == 18 and images.run_offsets == [0, 10]
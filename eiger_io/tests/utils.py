@@ -0,0 +1,59 @@
+import os
+
+import h5py
+import numpy as np
+
+
+def make_run(dirname, base='scan', seq_id=1, nimages=10, images_per_file=4,
+             frame_shape=(16, 20), dtype='uint32', compression='gzip',
+             chunks=None, in_master=False):
+    ''' Write a small EIGER run: a master file linking to its data files,
+        or with in_master the data in the master file (older firmware).
+
+        Returns
+        -------
+        master_path : str
+
+        data : numpy.ndarray
+            the frames written
+    '''
+    prefix = os.path.join(dirname, '{}_{}'.format(base, seq_id))
+    master_path = prefix + '_master.h5'
+    rng = np.random.RandomState(seq_id)
+    data = rng.randint(0, 1000, size=(nimages,) + frame_shape).astype(dtype)
+    n_files = -(-nimages // images_per_file)
+    with h5py.File(master_path, 'w') as f:
+        det = f.create_group('entry/instrument/detector')
+        for k, v in [('y_pixel_size', 75e-6), ('x_pixel_size', 75e-6),
+                     ('detector_distance', 5.), ('frame_time', .01),
+                     ('beam_center_x', 10.), ('beam_center_y', 8.),
+                     ('count_time', .009), ('threshold_energy', 4000.)]:
+            det[k] = v
+        f['entry/instrument/beam/incident_wavelength'] = 1.
+        specific = det.create_group('detectorSpecific')
+        pixel_mask = np.zeros(frame_shape, dtype='uint32')
+        pixel_mask[0, 0] = 1
+        specific['pixel_mask'] = pixel_mask
+        specific['flatfield'] = np.full(frame_shape, 1.5, dtype='float32')
+        specific['nimages'] = nimages
+        specific['ntrigger'] = 1
+        for i in range(n_files):
+            key = 'entry/data/data_{:06d}'.format(i + 1)
+            if in_master:
+                _write_block(f, key, data, i, images_per_file, chunks,
+                             compression)
+            else:
+                f[key] = h5py.ExternalLink(
+                    os.path.basename(prefix) +
+                    '_data_{:06d}.h5'.format(i + 1), '/entry/data/data')
+    for i in range(0 if in_master else n_files):
+        with h5py.File(prefix + '_data_{:06d}.h5'.format(i + 1), 'w') as f:
+            _write_block(f, 'entry/data/data', data, i, images_per_file,
+                         chunks, compression)
+    return master_path, data
+
+
+def _write_block(f, name, data, i, images_per_file, chunks, compression):
+    block = data[i * images_per_file:(i + 1) * images_per_file]
+    f.create_dataset(name, data=block, chunks=chunks or (1,) + block.shape[1:],
+                     compression=compression)
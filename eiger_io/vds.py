@@ -0,0 +1,121 @@
+''' Join the data files of EIGER runs into one HDF5 virtual dataset.
+
+    The detector splits a run over data files of ``images_per_file``
+    frames, and a scan over one master file per ``seq_id``. ``write_vds``
+    writes a small HDF5 file whose ``entry/data/data`` is a virtual dataset
+    mapping onto all of those data files, without copying any frames:
+
+    - ``layout='frames'`` concatenates the runs into (N, y, x), the start
+      of every run being in ``entry/data/run_offsets``
+    - ``layout='points'`` stacks them into (points, frames, y, x), for
+      scans with the same number of frames at every point
+
+    The metadata of the first run is copied to the paths of the master
+    file. The layout is that of ``eiger_io.repack``, so ``RepackedImages``
+    reads the file, and so can any HDF5 tool: strided reads across data
+    files and runs are a single HDF5 call.
+
+    Source files are referenced relative to the virtual dataset file, keep
+    them together when moving runs.
+'''
+import os
+
+import h5py
+import numpy as np
+
+from .fs_handler import EigerHandler
+from .index import RunIndex
+from .repack import DATA_PATH, OFFSETS_PATH
+
+
+def scan_master_paths(fpath, seq_ids):
+    ''' The master files of a scan, as the handlers find them.'''
+    return ['{}_{}_master.h5'.format(fpath, seq_id) for seq_id in seq_ids]
+
+
+def _sources(master_path, dest_dir):
+    ''' (relative data file path, dataset path, frame count) of every data
+        file of a run, and its frame shape and dtype.'''
+    index = RunIndex.open(master_path, write=False)
+    sources = [(os.path.relpath(index.data_path(i), dest_dir), f['dataset'],
+                f['nframes']) for i, f in enumerate(index.files)]
+    return sources, index.frame_shape, index.dtype
+
+
+def write_vds(master_paths, dest, layout='frames'):
+    ''' Write a virtual dataset of one or more runs.
+
+        Parameters
+        ----------
+        master_paths : str or list of str
+            the master files, in order
+
+        dest : str
+            the HDF5 file to write
+
+        layout : {'frames', 'points'}, optional
+            concatenate the runs along the frame axis, or stack them along
+            a new first axis
+
+        Returns
+        -------
+        dest : str
+    '''
+    if isinstance(master_paths, str):
+        master_paths = [master_paths]
+    if layout not in ('frames', 'points'):
+        raise ValueError("layout must be 'frames' or 'points'")
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    runs = [_sources(p, dest_dir) for p in master_paths]
+    frame_shape, dtype = runs[0][1], runs[0][2]
+    counts = []
+    for path, (sources, shape, dt) in zip(master_paths, runs):
+        if shape != frame_shape or dt != dtype:
+            raise ValueError("{} has frames of shape {} and type {}, "
+                             "expected {} and {}".format(path, shape, dt,
+                                                         frame_shape, dtype))
+        counts.append(sum(n for _, _, n in sources))
+    offsets = np.cumsum([0] + counts)
+    if layout == 'frames':
+        shape = (int(offsets[-1]),) + tuple(frame_shape)
+    else:
+        if len(set(counts)) > 1:
+            raise ValueError("The runs have {} frames, layout='points' "
+                             "needs the same number in every run"
+                             .format(counts))
+        shape = (len(runs), counts[0]) + tuple(frame_shape)
+    vlayout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    for k, (sources, _, _) in enumerate(runs):
+        start = 0
+        for filename, name, n in sources:
+            source = h5py.VirtualSource(filename, name,
+                                        shape=(n,) + tuple(frame_shape))
+            if layout == 'frames':
+                first = int(offsets[k]) + start
+                vlayout[first:first + n] = source
+            else:
+                vlayout[k, start:start + n] = source
+            start += n
+    md = EigerHandler._load_md(master_paths[0])
+    with h5py.File(dest, 'w') as f:
+        f.create_virtual_dataset(DATA_PATH, vlayout)
+        f[OFFSETS_PATH] = offsets[:-1]
+        for k, v in EigerHandler.EIGER_MD_LAYOUT.items():
+            f[v] = md[k]
+    return dest
+
+
+def write_scan_vds(fpath, seq_ids, dest, layout='points'):
+    ''' Write a virtual dataset of every run of a scan.
+
+        Parameters
+        ----------
+        fpath : str
+            the base path of the runs, as given to the handlers
+
+        seq_ids : iterable
+            the sequence ids of the runs, in order
+
+        See ``write_vds`` for the other parameters.
+    '''
+    return write_vds(scan_master_paths(fpath, seq_ids), dest, layout)
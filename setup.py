@@ -4,5 +4,7 @@ import versioneer
 setup(version=versioneer.get_version(),
       cmdclass=versioneer.get_cmdclass(),
       name='eiger_io',
-      packages=['eiger_io'])
+      packages=['eiger_io'],
+      entry_points={
+          'console_scripts': ['eiger-io-probe = eiger_io.probe:main']})
 